@@ -0,0 +1,158 @@
+# HTTP/JSON API for the controller's live status and recorded history
+# Copyright 2020 Jonathan Schultz
+#
+# Requests are handled one at a time from a thread of their own, so a slow
+# client holds up other clients but never the controller. They read the
+# controller's latest status, temperatures and state, each of which it replaces
+# whole, and recorded history from the files, which are safe to read while they
+# are written, so they need no locks and never cause a request to the charger.
+# Each response carries an ETag, so pollers that send If-None-Match get a 304
+# until something changes. History is cached per query, and rollups are only
+# served up to the last complete bucket, so a cached response holds until the
+# next bucket is complete.
+#
+#   /status                                    latest status, temperatures and state
+#   /history?metric=bat_volt&secs=86400&points=100
+#   /history?metric=temp1&start=...&end=...&points=100
+
+import json, math, time, zlib, threading, collections, urllib.parse, http.server
+import esmart
+import rollup
+import metrics
+
+API_HOST = 'localhost'
+
+# Seconds a client may wait to send its request before it is dropped, since
+# other clients wait for it
+REQUEST_TIMEOUT = 1
+
+HISTORY_CACHE = 64
+HISTORY_POINTS = 100
+
+REQUESTS = {code: metrics.counter('esmartfsm_api_requests_total', 'API requests by response code', {'code': code})
+            for code in (200, 304, 400, 404)}
+
+class apiError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+def etag(*key):
+    return '"%08x"' % zlib.crc32(repr(key).encode())
+
+# The controller's state, entered time, load shedding, (time, status) and
+# (time, temperatures), read once so that a response and its ETag agree
+def view(controller):
+    return (controller.state, controller.entered, controller.load_shed, controller.status, controller.temps)
+
+def status(view):
+    state, entered, load_shed, latest, temps = view
+    status_time, data = latest or (None, None)
+    temps_time, tempsensors = temps or (None, None)
+    return {'state': state, 'entered': entered, 'load_shed': load_shed,
+            'status_time': status_time, 'status': data.asdict() if data else None,
+            'charge_mode': esmart.DEVICE_MODE[data.chg_mode] if data else None,
+            'temps_time': temps_time, 'temps': list(tempsensors) if tempsensors else None}
+
+class handler(http.server.BaseHTTPRequestHandler):
+    timeout = REQUEST_TIMEOUT
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            if url.path == '/status':
+                self.get_status()
+            elif url.path == '/history':
+                self.get_history(urllib.parse.parse_qs(url.query))
+            else:
+                raise apiError(404, "Not found")
+        except apiError as exception:
+            self.reply(exception.code, json.dumps({'error': str(exception)}).encode())
+
+    def get_status(self):
+        current = view(self.server.controller)
+        state, entered, load_shed, data, temps = current
+        tag = etag(state, entered, load_shed, data and data[0], temps and temps[0])
+        if self.server.status[0] != tag:
+            self.server.status = (tag, json.dumps(status(current)).encode())
+        self.reply(200, self.server.status[1], tag, 'no-cache')
+
+    def get_history(self, query):
+        controller = self.server.controller
+        if not controller.rollup:
+            raise apiError(404, "No history is recorded")
+        try:
+            metric = query['metric'][0]
+            points = int(query.get('points', [HISTORY_POINTS])[0])
+            if 'secs' in query:
+                end = time.time()
+                start = end - float(query['secs'][0])
+            else:
+                start = float(query['start'][0])
+                end = float(query['end'][0]) if 'end' in query else time.time()
+        except (KeyError, IndexError, ValueError):
+            raise apiError(400, "Give metric, and secs or start and optionally end")
+        if metric not in rollup.METRICS:
+            raise apiError(400, "Unknown metric %s, not one of %s" % (metric, ', '.join(rollup.METRICS)))
+        if points <= 0 or end <= start:
+            raise apiError(400, "Give a positive number of points over a positive time")
+
+        # Rollups end at the last complete bucket, so the response only changes
+        # when another is written. Raw samples change with every sample, so a
+        # range up to now ends just after the newest.
+        resolution = controller.rollup.resolution(start, end, points)
+        if resolution:
+            start -= start % resolution
+            end -= end % resolution
+            generation = controller.rollup.flushed[resolution]
+            max_age = int(resolution - time.time() % resolution)
+        else:
+            generation = controller.status and controller.status[0]
+            if 'secs' in query and generation:
+                end = math.floor(generation) + 1
+                start = end - float(query['secs'][0])
+            max_age = 0
+        key = (metric, resolution, start, end)
+        tag = etag(key, generation)
+
+        cache = self.server.history
+        cached = cache.get(key)
+        if not cached or cached[0] != tag:
+            rows = [row for row in controller.rollup.rows(metric, start, end, resolution) if row[0] < end]
+            body = json.dumps({'metric': metric, 'resolution': resolution, 'start': start, 'end': end,
+                               'fields': ['time', 'min', 'max', 'mean'], 'rows': rows}).encode()
+            cached = cache[key] = (tag, body)
+            if len(cache) > HISTORY_CACHE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        self.reply(200, cached[1], tag, 'max-age=%d' % max_age if max_age else 'no-cache')
+
+    def reply(self, code, body, tag=None, cache_control=None):
+        if tag and tag in self.headers.get('If-None-Match', '').replace(' ', '').split(','):
+            code = 304
+        REQUESTS.get(code, REQUESTS[400]).inc()
+        self.send_response(code)
+        if tag:
+            self.send_header('ETag', tag)
+        if cache_control:
+            self.send_header('Cache-Control', cache_control)
+        if code == 304:
+            self.end_headers()
+            return
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve the API for controller at http://host:port from a daemon thread
+def serve(port, controller, host=API_HOST):
+    server = http.server.HTTPServer((host, port), handler)
+    server.controller = controller
+    server.status = (None, None)
+    server.history = collections.OrderedDict()
+    threading.Thread(target=server.serve_forever, name='api', daemon=True).start()
+    return server
@@ -3,7 +3,8 @@
 # skagmo.com, 2018
 
 #import struct, time, serial, socket, requests
-import importlib, time, sys, select
+import importlib, os, time, sys, errno, select, struct, collections, random
+import metrics
 try:
     import serial
 except ModuleNotFoundError:
@@ -12,45 +13,445 @@ try:
     import socket
 except ModuleNotFoundError:
     pass
+try:
+    import numpy
+except ModuleNotFoundError:
+    pass
 
 # States
 STATE_START = 0
 STATE_DATA = 1
 
-REQUEST_MSG0 = b"\xaa\x01\x01\x01\x00\x03\x00\x00\x1e\x32"
-LOAD_OFF = b"\xaa\x01\x01\x02\x04\x04\x01\x00\xfe\x13\x38"
-LOAD_ON = b"\xaa\x01\x01\x02\x04\x04\x01\x00\xfd\x13\x39"
+FRAME_HEADER_LEN = 6
+
+# Byte 1 of a frame is the device address. esmart_server serves several chargers
+# and uses it to tell them apart, numbering them from 1 in the order it finds them.
+FRAME_ADDRESS = 1
+DEFAULT_ADDRESS = 1
+
+# Commands, in byte 3 of a frame. CMD_SAMPLES frames come only from
+# esmart_server, to compact subscribers.
+CMD_READ = 1
+CMD_WRITE = 2
+CMD_REPLY = 3
+CMD_SAMPLES = 0x53
+
+# Data blocks, in byte 4. Block 0 is the charger status and block 4 the load
+# switch; blocks 1 to 3 hold settings and counters, which are returned undecoded.
+BLOCK_STATUS = 0
+BLOCK_LOAD = 4
+BLOCKS = [0, 1, 2, 3, 4]
+
+# Reads give a start offset and a number of bytes
+READ_LAYOUT = struct.Struct('<HB')
+READ_LENGTH = 30
+
+def checksum(frame):
+    return -sum(frame) & 0xff
+
+def build_frame(command, block, data, address=DEFAULT_ADDRESS):
+    message = bytearray([0xaa, address, 0x01, command, block, len(data)]) + data
+    message.append(checksum(message))
+    return bytes(message)
+
+# The data in a frame, between the header and the checksum
+def payload(frame):
+    return frame[FRAME_HEADER_LEN:-1]
+
+def read_request(block, start=0, length=READ_LENGTH, address=DEFAULT_ADDRESS):
+    return build_frame(CMD_READ, block, READ_LAYOUT.pack(start, length), address)
+
+REQUEST_MSG0 = read_request(BLOCK_STATUS)                    # aa 01 01 01 00 03 00 00 1e 32
+LOAD_OFF = build_frame(CMD_WRITE, BLOCK_LOAD, b"\x01\x00\xfe\x13")     # aa 01 01 02 04 04 01 00 fe 13 38
+LOAD_ON = build_frame(CMD_WRITE, BLOCK_LOAD, b"\x01\x00\xfd\x13")      # aa 01 01 02 04 04 01 00 fd 13 39
+
+# Sent to esmart_server, followed by the unit and a newline, to have it push
+# every status frame it polls from that charger
+SUBSCRIBE_MSG = b"SUBSCRIBE"
+# Sent instead, followed by the unit and optionally the time of the newest
+# sample already received, to have the samples pushed in CMD_SAMPLES frames,
+# starting with any since that time that the server still has.
+SAMPLES_MSG = b"SAMPLES"
 
 DEVICE_MODE = ["IDLE", "CC", "CV", "FLOAT", "STARTING"]
 
+CONNECT_TIMEOUT = 2
+HEALTH_SECS = 15
+RECONNECT_MIN_SECS = 0.05
+RECONNECT_MAX_SECS = 30
+
+# Times a load write is sent before giving up if status frames don't show it
+LOAD_RETRIES = 3
+
+# Samples kept that arrived but were superseded before being returned
+MISSED_SAMPLES = 720
+
+READ_SECONDS = metrics.histogram('esmart_read_seconds', 'Time from status request to reply in esmart.read()')
+BLOCKS_READ_SECONDS = metrics.histogram('esmart_read_blocks_seconds', 'Time to read several blocks in esmart.read_blocks()')
+GROUP_READ_SECONDS = metrics.histogram('esmart_group_read_seconds', 'Time to read the status of a group of chargers')
+FRAMES = metrics.counter('esmart_frames_total', 'Frames received from eSmart devices')
+TIMEOUTS = metrics.counter('esmart_timeouts_total', 'Reads that got no reply in time')
+CONNECTIONS_LOST = metrics.counter('esmart_connections_lost_total', 'Connections to eSmart devices lost')
+RECONNECTS = metrics.counter('esmart_reconnects_total', 'Connection attempts to eSmart devices by result', {'result': 'connected'})
+RECONNECT_FAILURES = metrics.counter('esmart_reconnects_total', 'Connection attempts to eSmart devices by result', {'result': 'failed'})
+LOAD_WRITES = metrics.counter('esmart_load_writes_total', 'Load on and off writes sent')
+LOAD_UNCONFIRMED = metrics.counter('esmart_load_unconfirmed_total', 'Load writes given up on without status frames showing their effect')
+
 class esmartError(Exception):
     pass
 
-class esmart:
+# Incremental frame decoder. Bytes are accumulated across reads so that replies
+# split over several reads or glued to other replies are still recovered.
+# A frame is 0xaa, four header bytes, a data length byte, the data and a checksum
+# byte that brings the sum of the whole frame to zero.
+class decoder:
     def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def frames(self):
+        buffer = self.buffer
+        while True:
+            start = buffer.find(0xaa)
+            if start == -1:
+                del buffer[:]
+                return
+            del buffer[:start]
+            if len(buffer) < FRAME_HEADER_LEN:
+                return
+            length = FRAME_HEADER_LEN + buffer[5] + 1
+            if len(buffer) < length:
+                # Either the frame is incomplete or this 0xaa is noise. In the latter
+                # case a complete frame may already follow it, so look for one.
+                start = self.find(1)
+                if start == -1:
+                    return
+                del buffer[:start]
+                continue
+            if sum(buffer[:length]) & 0xff:
+                # Bad checksum, so this 0xaa was not a start character; resynchronize
+                del buffer[0]
+                continue
+
+            frame = bytes(buffer[:length])
+            del buffer[:length]
+            yield frame
+
+    def find(self, start=0):
+        buffer = self.buffer
+        start = buffer.find(0xaa, start)
+        while start != -1:
+            length = FRAME_HEADER_LEN + buffer[start + 5] + 1 if len(buffer) >= start + FRAME_HEADER_LEN else 0
+            if length and len(buffer) >= start + length and not sum(buffer[start:start + length]) & 0xff:
+                return start
+            start = buffer.find(0xaa, start + 1)
+        return -1
+
+# Return a copy of a frame with its address byte and checksum replaced
+def readdress(frame, address):
+    if frame[FRAME_ADDRESS] == address:
+        return frame
+    frame = bytearray(frame)
+    frame[FRAME_ADDRESS] = address
+    frame[-1] = 0
+    frame[-1] = checksum(frame)
+    return bytes(frame)
+
+# Status fields start at offset 8 of a status frame; the scale factors convert
+# the raw little-endian values to volts and amps.
+STATUS_LAYOUT = struct.Struct('<HHHH2xHHHHBxBxB3xH')
+STATUS_OFFSET = 8
+STATUS_FIELDS  = ['chg_mode', 'pv_volt', 'bat_volt', 'chg_cur', 'load_volt', 'load_cur', 'chg_power', 'load_power', 'bat_temp', 'int_temp', 'soc', 'co2_gram']
+STATUS_SCALE   = [1,          10.0,      10.0,       10.0,      10.0,        10.0,       1,           1,            1,          1,          1,     1         ]
+# Byte offsets of the fields within a frame, and their NumPy types, for batch decoding
+STATUS_OFFSETS = [8,          10,        12,         14,        18,          20,         22,          24,           26,         28,         30,    34        ]
+STATUS_DTYPES  = ['<u2',      '<u2',     '<u2',      '<u2',     '<u2',       '<u2',      '<u2',       '<u2',        'u1',       'u1',       'u1',  '<u2'     ]
+
+# Status record. It behaves like the dict that read() used to return, so that
+# data['bat_volt'] still works, as well as data.bat_volt.
+class status(collections.namedtuple('status', STATUS_FIELDS)):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return self._fields
+
+    def asdict(self):
+        return dict(zip(self._fields, self))
+
+# Charge modes from least to most charged. STARTING counts as IDLE.
+MODE_RANK = [0, 2, 3, 4, 1]
+
+# Status of several chargers on one battery bank taken together. Currents and
+# powers are summed; battery voltage is the lowest, and the charge mode is the
+# least advanced, so that the bank is only judged full when every charger is.
+class groupstatus(collections.namedtuple('groupstatus', STATUS_FIELDS + ['units', 'bat_volt_min', 'bat_volt_max'])):
+    __slots__ = ()
+
+    __getitem__ = status.__getitem__
+    keys = status.keys
+    asdict = status.asdict
+
+def aggregate(statuses):
+    statuses = [status for status in statuses if status]
+    if not statuses:
+        raise esmartError("No status to aggregate")
+    bat_volts = [status.bat_volt for status in statuses]
+    return groupstatus(
+        chg_mode   = min((status.chg_mode for status in statuses), key=lambda mode: MODE_RANK[mode]),
+        pv_volt    = max(status.pv_volt for status in statuses),
+        bat_volt   = min(bat_volts),
+        chg_cur    = round(sum(status.chg_cur for status in statuses), 1),
+        load_volt  = max(status.load_volt for status in statuses),
+        load_cur   = round(sum(status.load_cur for status in statuses), 1),
+        chg_power  = sum(status.chg_power for status in statuses),
+        load_power = sum(status.load_power for status in statuses),
+        bat_temp   = max(status.bat_temp for status in statuses),
+        int_temp   = max(status.int_temp for status in statuses),
+        soc        = min(status.soc for status in statuses),
+        co2_gram   = sum(status.co2_gram for status in statuses),
+        units      = len(statuses),
+        bat_volt_min = min(bat_volts),
+        bat_volt_max = max(bat_volts))
+
+def parse(data, offset=0):
+    if len(data) < offset + STATUS_OFFSET + STATUS_LAYOUT.size:
+        raise esmartError("Status frame too short: %d bytes" % (len(data) - offset))
+    return from_raw(STATUS_LAYOUT.unpack_from(data, offset + STATUS_OFFSET))
+
+# Status from the raw field values, as they are in a frame
+def from_raw(values):
+    (chg_mode, pv_volt, bat_volt, chg_cur, load_volt, load_cur, chg_power, load_power, bat_temp, int_temp, soc, co2_gram) = values
+    if chg_mode >= len(DEVICE_MODE):
+        raise esmartError("Charge mode out of range: ", str(chg_mode))
+
+    return status(chg_mode, pv_volt / 10.0, bat_volt / 10.0, chg_cur / 10.0, load_volt / 10.0, load_cur / 10.0, chg_power, load_power, bat_temp, int_temp, soc, co2_gram)
+
+# Compact samples. Each sample in a CMD_SAMPLES frame is the change in time, in
+# tenths of a second, a bit mask of the raw status fields that changed, and the
+# change in each of those fields, all as varints, so a typical sample takes a
+# few bytes. Changes are from the previous sample sent on the connection, which
+# starts from zero, so as many samples as fit go in a frame.
+def put_varint(data, value):
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+
+def get_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+# Signed values as unsigned, small either way: 0, -1, 1, -2... as 0, 1, 2, 3...
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+class sampleencoder:
+    def __init__(self):
+        self.ticks = 0
+        self.values = (0,) * len(STATUS_FIELDS)
+
+    # Encode (time, raw values) samples into as few frames as they fit
+    def encode(self, samples, address=DEFAULT_ADDRESS):
+        frames = []
+        data = bytearray()
+        for timestamp, values in samples:
+            ticks = int(round(timestamp * 10))
+            sample = bytearray()
+            put_varint(sample, zigzag(ticks - self.ticks))
+            mask = 0
+            changes = bytearray()
+            for field, (value, previous) in enumerate(zip(values, self.values)):
+                if value != previous:
+                    mask |= 1 << field
+                    put_varint(changes, zigzag(value - previous))
+            put_varint(sample, mask)
+            sample += changes
+            self.ticks = ticks
+            self.values = values
+
+            if len(data) + len(sample) > 0xff:
+                frames.append(build_frame(CMD_SAMPLES, BLOCK_STATUS, data, address))
+                data = bytearray()
+            data += sample
+        if data:
+            frames.append(build_frame(CMD_SAMPLES, BLOCK_STATUS, data, address))
+        return frames
+
+class sampledecoder:
+    def __init__(self):
+        self.ticks = 0
+        self.values = (0,) * len(STATUS_FIELDS)
+
+    # Return the (time, raw values) samples in a CMD_SAMPLES frame
+    def decode(self, frame):
+        data = payload(frame)
+        samples = []
+        offset = 0
+        try:
+            while offset < len(data):
+                change, offset = get_varint(data, offset)
+                self.ticks += unzigzag(change)
+                mask, offset = get_varint(data, offset)
+                values = list(self.values)
+                field = 0
+                while mask:
+                    if mask & 1:
+                        change, offset = get_varint(data, offset)
+                        values[field] += unzigzag(change)
+                    mask >>= 1
+                    field += 1
+                self.values = tuple(values)
+                samples.append((self.ticks / 10.0, self.values))
+        except IndexError:
+            raise esmartError("Truncated samples frame")
+        return samples
+
+# Decode many status frames of the same length at once into NumPy columns,
+# for example when replaying logged frames.
+def parse_batch(frames):
+    if 'numpy' not in sys.modules:
+        raise esmartError("Missing module: numpy")
+
+    frames = [frame for frame in frames if frame[3] == CMD_REPLY and frame[4] == BLOCK_STATUS]
+    if not frames:
+        return {field: numpy.empty(0) for field in STATUS_FIELDS}
+    length = len(frames[0])
+    if any(len(frame) != length for frame in frames):
+        raise esmartError("Status frames differ in length")
+
+    dtype = numpy.dtype({
+        'names':    STATUS_FIELDS,
+        'formats':  STATUS_DTYPES,
+        'offsets':  STATUS_OFFSETS,
+        'itemsize': length })
+    records = numpy.frombuffer(b''.join(frames), dtype=dtype)
+
+    columns = {}
+    for field, scale in zip(STATUS_FIELDS, STATUS_SCALE):
+        columns[field] = records[field] / scale if scale != 1 else records[field].astype(int)
+    return columns
+
+# An esmart object talks to one charger, either directly over a serial port or
+# through esmart_server over TCP. Given a list of endpoints (serial port names
+# or (host, port) addresses) it connects to the first that works, preferring
+# earlier ones, and reconnects with exponential backoff when the link fails.
+# Through esmart_server, unit is the address of the charger to talk to.
+class esmart:
+    def __init__(self, unit=DEFAULT_ADDRESS):
+        self.unit = unit
         self.serial = None
         self.port = ""
         self.timeout = 0
         self.socket = None
+        self.decoder = decoder()
+        self.subscription = False
+        self.subscribed = False
+        self.compact = False
+        self.unpacker = sampledecoder()
+        self.sample_time = None
+        self.sample = None
+        self.skipped = collections.deque(maxlen=MISSED_SAMPLES)
+        self.endpoints = []
+        self.endpoint = None
+        self.connecting = None
+        self.errors = []
+        self.failures = 0
+        self.retry_at = 0
+        self.last_frame = None
+        self.requested_at = None
+        self.load_target = None
+        self.load_state = None
+        self.load_pending = False
+        self.load_awaiting = False
+        self.load_attempts = 0
+        # Over a serial port, a request to send when the reply to the last arrives
+        self.following = None
 
     def __del__(self):
         self.close()
 
     def open(self, port):
         if 'serial' in sys.modules:
-            self.serial = serial.Serial(port,9600,timeout=0.1)
+            try:
+                self.serial = serial.Serial(port,9600,timeout=0.1)
+            except serial.serialutil.SerialException as exception:
+                raise esmartError("Can't open %s: %s" % (port, exception))
             self.port = port
+            self.attached(port)
         else:
             raise esmartError("Missing module: serial")
 
     def connect(self, address):
         if 'socket' in sys.modules:
-            self.socket = socket.create_connection(address)
-            self.socket.setblocking(0)
-            self.address = address
+            try:
+                self.socket = socket.create_connection(address, CONNECT_TIMEOUT)
+            except OSError as exception:
+                raise esmartError("Can't connect to %s:%s: %s" % (address[0], address[1], exception))
+            self.established(address)
         else:
             raise esmartError("Missing module: socket")
 
+    # Start connecting without waiting, returning whether the connection is
+    # still in progress, in which case finish_connect() completes it.
+    def start_connect(self, address):
+        if 'socket' not in sys.modules:
+            raise esmartError("Missing module: socket")
+        try:
+            family, kind, protocol, name, sockaddr = socket.getaddrinfo(address[0], address[1], type=socket.SOCK_STREAM)[0]
+            self.socket = socket.socket(family, kind, protocol)
+            self.socket.setblocking(0)
+            error = self.socket.connect_ex(sockaddr)
+            if error == errno.EINPROGRESS:
+                return True
+            if error:
+                raise OSError(error, os.strerror(error))
+            self.established(address)
+            return False
+        except OSError as exception:
+            self.close()
+            raise esmartError("Can't connect to %s:%s: %s" % (address[0], address[1], exception))
+
+    def established(self, address):
+        self.socket.setblocking(0)
+        self.address = address
+        self.attached(address)
+        if self.subscription:
+            self.socket.send(self.subscribe_message())
+            self.subscribed = True
+            if self.load_pending:
+                self.queue_load()
+
+    def attached(self, endpoint):
+        self.endpoint = endpoint
+        if endpoint not in self.endpoints:
+            self.endpoints.append(endpoint)
+        self.decoder = decoder()
+        self.unpacker = sampledecoder()
+        self.subscribed = False
+        self.last_frame = time.time()
+        self.requested_at = None
+        self.following = None
+        if self.load_awaiting:
+            # The write may have been lost with the old connection
+            self.load_awaiting = False
+            self.load_pending = True
+
     def close(self):
         try:
             if self.serial:
@@ -61,68 +462,422 @@ class esmart:
                 self.socket = None
         except AttributeError:
             pass
+        self.subscribed = False
+        self.connecting = None
 
-    def read(self, timeout=None):
+    def connected(self):
+        return bool(self.serial or self.socket) and self.connecting is None
+
+    # Unhealthy means a request has gone unanswered for HEALTH_SECS, which can
+    # happen with no error from a half-open TCP connection or a dead USB link.
+    def healthy(self):
+        return (self.connected() and
+                not (self.requested_at and self.requested_at - self.last_frame > 0 and time.time() - self.requested_at > HEALTH_SECS))
+
+    # Try each endpoint in order, so that we fail back to the primary when it
+    # recovers. If none works, back off exponentially with jitter; until then
+    # reconnect() fails at once rather than blocking.
+    #
+    # Without wait, a TCP connection is only started, and None is returned
+    # while it is in progress. The caller waits for the esmart object to be
+    # writable and calls finish_connect(), or abandon_connect() if it takes
+    # longer than CONNECT_TIMEOUT; either goes on to the next endpoint if need be.
+    def reconnect(self, wait=True):
+        now = time.time()
+        if now < self.retry_at:
+            raise esmartError("Waiting %.1fs before reconnecting to eSmart device" % (self.retry_at - now))
+
+        self.close()
+        self.errors = []
+        return self.try_endpoints(0, wait)
+
+    def try_endpoints(self, first, wait):
+        for index in range(first, len(self.endpoints)):
+            endpoint = self.endpoints[index]
+            try:
+                if isinstance(endpoint, str):
+                    self.open(endpoint)
+                elif wait:
+                    self.connect(endpoint)
+                elif self.start_connect(endpoint):
+                    self.connecting = index
+                    return None
+                return self.reconnected(endpoint)
+            except esmartError as exception:
+                self.errors.append(str(exception))
+
+        RECONNECT_FAILURES.inc()
+        self.failures += 1
+        self.retry_at = time.time() + random.uniform(0, min(RECONNECT_MAX_SECS, RECONNECT_MIN_SECS * 2 ** self.failures))
+        raise esmartError("Can't connect to eSmart device: %s" % '; '.join(self.errors) if self.errors else "No eSmart endpoints")
+
+    def reconnected(self, endpoint):
+        self.failures = 0
+        self.retry_at = 0
+        RECONNECTS.inc()
+        return endpoint
+
+    def finish_connect(self):
+        index = self.connecting
+        address = self.endpoints[index]
+        self.connecting = None
+        try:
+            error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise OSError(error, os.strerror(error))
+            self.established(address)
+            return self.reconnected(address)
+        except OSError as exception:
+            self.errors.append("Can't connect to %s:%s: %s" % (address[0], address[1], exception))
+        self.close()
+        return self.try_endpoints(index + 1, False)
+
+    def abandon_connect(self):
+        index = self.connecting
+        address = self.endpoints[index]
+        self.errors.append("Can't connect to %s:%s: timed out" % (address[0], address[1]))
+        self.close()
+        return self.try_endpoints(index + 1, False)
+
+    def retry_delay(self):
+        return max(self.retry_at - time.time(), 0)
+
+    def lost(self, exception):
+        CONNECTIONS_LOST.inc()
+        self.close()
+        return esmartError("Lost connection to eSmart device %s: %s" % (self.endpoint, exception))
+
+    def receive(self, timeout=None):
+        data = None
         try:
-            data = None
             if self.serial:
-                self.serial.write(REQUEST_MSG0)
                 ready = select.select([self.serial], [], [], timeout)
                 if ready[0]:
-                    data = self.serial.read(1024)
+                    data = self.serial.read(self.serial.in_waiting or 1)
             elif self.socket:
-                self.socket.send(REQUEST_MSG0)
                 ready = select.select([self.socket], [], [], timeout)
                 if ready[0]:
                     data = self.socket.recv(1024)
+                    if not data:
+                        raise self.lost("connection closed by eSmart server")
+            else:
+                raise esmartError("Not connected to eSmart device")
+        except OSError as exception:
+            raise self.lost(exception)
+
+        if data:
+            self.decoder.feed(data)
+        return data
+
+    # A closed connection has no file descriptor, as with a closed socket
+    def fileno(self):
+        if self.serial:
+            return self.serial.fileno()
+        elif self.socket:
+            return self.socket.fileno()
+        return -1
+
+    def send(self, message):
+        try:
+            if self.serial:
+                self.serial.write(message)
+            elif self.socket:
+                self.socket.send(message)
+            else:
+                raise esmartError("Not connected to eSmart device")
+        except OSError as exception:
+            raise self.lost(exception)
+
+    # A status reply from our charger. Over TCP, replies and pushed samples from
+    # every charger behind the server arrive, so check the address too.
+    def is_status(self, frame):
+        return self.is_reply(frame, BLOCK_STATUS)
+
+    def is_reply(self, frame, block):
+        return frame[3] == CMD_REPLY and frame[4] == block and (self.serial or frame[FRAME_ADDRESS] == self.unit)
+
+    # Note the arrival of a frame and return the statuses in it from our charger,
+    # with the time of each: one from a status reply, or any number from a
+    # compact samples frame. Every samples frame must come through here, since
+    # each sample is decoded from the one before.
+    def received(self, frame):
+        FRAMES.inc()
+        self.last_frame = time.time()
+        if self.following:
+            message, self.following = self.following, None
+            self.send(message)
+        if frame[3] == CMD_SAMPLES:
+            if frame[FRAME_ADDRESS] != self.unit:
+                return []
+            samples = self.unpacker.decode(frame)
+            if samples:
+                self.sample_time = samples[-1][0]
+            return [(timestamp, from_raw(values)) for timestamp, values in samples]
+        if self.is_status(frame):
+            return [(self.last_frame, parse(frame))]
+        return []
+
+    # Drop the frames received so far, keeping samples as missed
+    def discard(self):
+        for frame in self.decoder.frames():
+            if frame[3] == CMD_SAMPLES:
+                self.skipped.extend(self.received(frame))
+
+    # Return and forget the samples that arrived but were superseded by a newer
+    # one before being returned, such as those caught up on after reconnecting,
+    # as (time, status) oldest first.
+    def missed(self):
+        missed = list(self.skipped)
+        self.skipped.clear()
+        return missed
+
+    # Send a status request without waiting for the reply, which poll() returns
+    # once it has arrived.
+    def request(self):
+        # Discard complete replies left over from earlier requests, but keep any
+        # partial frame since the rest of it may already be on its way.
+        self.receive(0)
+        self.discard()
+
+        message = readdress(REQUEST_MSG0, self.unit) if self.socket else REQUEST_MSG0
+        self.following = None
+        if self.load_pending:
+            # The write goes in front of the status request, so the reply to the
+            # request shows whether it took effect. Through esmart_server they go
+            # together; over a serial port the request waits for the write's reply,
+            # as in read_blocks(), or failing that goes with the next request.
+            if self.socket:
+                message = self.load_message() + message
+            else:
+                self.following = message
+                message = self.load_message()
+            self.load_sent()
+        self.send(message)
+        if not self.requested_at or self.requested_at < self.last_frame:
+            self.requested_at = time.time()
 
-            #print("Read: ", [hex(data[idx]) for idx in range(len(data))])
-            idx = data.find(0xaa) if data else -1
-            if idx == -1:
+    # Read several blocks, returning the reply frame for each by block number.
+    # Through esmart_server the requests are sent together and the replies
+    # matched by their headers as they arrive, so reading them all takes about
+    # as long as one request. Over a serial port each request waits for the
+    # previous reply, since the charger is not known to queue requests.
+    def read_blocks(self, blocks=BLOCKS, timeout=None):
+        if not self.connected():
+            self.reconnect()
+        self.receive(0)
+        self.discard()
+
+        address = self.unit if self.socket else DEFAULT_ADDRESS
+        requests = [read_request(block, address=address) for block in blocks]
+        pending = list(blocks)
+        replies = {}
+        started = time.perf_counter()
+        deadline = time.time() + timeout if timeout is not None else None
+        self.send(b''.join(requests) if self.socket else requests[0])
+        while pending:
+            for frame in self.decoder.frames():
+                statuses = self.received(frame)
+                for block in pending:
+                    if self.is_reply(frame, block):
+                        replies[block] = frame
+                        pending.remove(block)
+                        if block == BLOCK_STATUS:
+                            self.observe(statuses[-1][1])
+                            statuses = []
+                        if self.serial and pending:
+                            self.send(requests[blocks.index(pending[0])])
+                        break
+                self.skipped.extend(statuses)
+            if not pending:
+                break
+
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            if not self.receive(remaining):
+                TIMEOUTS.inc()
+                raise esmartError("No reply from eSmart device for block %s" % ', '.join(str(block) for block in pending))
+
+        BLOCKS_READ_SECONDS.observe(time.perf_counter() - started)
+        return replies
+
+    # Ask for the load output to be switched on or off. The write goes out with
+    # the next status request, or at once when subscribed, and is sent again
+    # while status frames show the load in the other state, up to LOAD_RETRIES
+    # times. Asking again for the state already asked for sends nothing more.
+    def set_load(self, on):
+        on = bool(on)
+        if on == self.load_target and (self.load_pending or self.load_awaiting or self.load_state == on):
+            return
+        self.load_target = on
+        self.load_attempts = 0
+        if self.load_state == on and not self.load_awaiting:
+            self.load_pending = False
+        else:
+            self.queue_load()
+
+    def load_confirmed(self):
+        return self.load_target is not None and self.load_state == self.load_target and not (self.load_pending or self.load_awaiting)
+
+    def load_message(self):
+        message = LOAD_ON if self.load_target else LOAD_OFF
+        return readdress(message, self.unit) if self.socket else message
+
+    def queue_load(self):
+        self.load_pending = True
+        if self.subscribed:
+            # No requests to go with, so send it now
+            self.send(self.load_message())
+            self.load_sent()
+
+    def load_sent(self):
+        self.load_pending = False
+        self.load_awaiting = True
+        self.load_attempts += 1
+        LOAD_WRITES.inc()
+
+    # Note the load state from a status frame, and check the effect of the last
+    # load write against it.
+    def observe(self, sample):
+        self.load_state = sample.load_volt > 0 or sample.load_cur > 0
+        if self.load_awaiting:
+            self.load_awaiting = False
+            if self.load_state != self.load_target:
+                if self.load_attempts < LOAD_RETRIES:
+                    self.queue_load()
+                else:
+                    LOAD_UNCONFIRMED.inc()
+        return sample
+
+    # Return the newest status that has arrived, without waiting, or None
+    def poll(self):
+        self.receive(0)
+        sample = None
+        for frame in self.decoder.frames():
+            for received in self.received(frame):
+                if sample:
+                    self.skipped.append(sample)
+                sample = received
+        return self.observe(sample[1]) if sample else None
+
+    def read(self, timeout=None):
+        if not self.connected():
+            self.reconnect()
+        started = time.perf_counter()
+        self.request()
+
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            for frame in self.decoder.frames():
+                #print("Read: ", [hex(frame[idx]) for idx in range(len(frame))])
+                statuses = self.received(frame)
+                if statuses:
+                    self.skipped.extend(statuses[:-1])
+                    READ_SECONDS.observe(time.perf_counter() - started)
+                    return self.observe(statuses[-1][1])
+
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            if not self.receive(remaining):
+                TIMEOUTS.inc()
                 raise esmartError("No data from eSmart device")
-            data = data[idx:]
-            if len(data) < 5:
-                raise esmartError("Insufficient data from eSmart device")
-            if (data[0] != 0xaa):
-                raise esmartError("Incorrect start character: ", [hex(data[idx]) for idx in range(len(data))])
-            if (data[3] != 3):
-                raise esmartError("Source is not MPPT device")
-            if (data[4] != 0):
-                raise esmartError("Packet type is not 0")
-
-            fields = {}
-            fields['chg_mode']   = int.from_bytes(data[8:10],  byteorder='little')
-            if fields['chg_mode'] < 0 or fields['chg_mode'] >= len(DEVICE_MODE):
-                raise esmartError("Charge mode out of range: ", str(fields['chg_mode']))
-            
-            fields['pv_volt']    = int.from_bytes(data[10:12], byteorder='little') / 10.0
-            fields['bat_volt']   = int.from_bytes(data[12:14], byteorder='little') / 10.0
-            fields['chg_cur']    = int.from_bytes(data[14:16], byteorder='little') / 10.0
-            fields['load_volt']  = int.from_bytes(data[18:20], byteorder='little') / 10.0
-            fields['load_cur']   = int.from_bytes(data[20:22], byteorder='little') / 10.0
-            fields['chg_power']  = int.from_bytes(data[22:24], byteorder='little')
-            fields['load_power'] = int.from_bytes(data[24:26], byteorder='little')
-            fields['bat_temp']   = data[26]
-            fields['int_temp']   = data[28]
-            fields['soc']        = data[30]
-            fields['co2_gram']   = int.from_bytes(data[34:36], byteorder='little')
-
-            return fields
-
-        except IOError:
-            #print("Serial port error, fixing")
-            self.serial.close()
-            opened = 0
-            while not opened:
+
+    # Ask esmart_server to push status frames as it polls them, and return an
+    # iterator over the samples. The subscription is renewed on reconnection;
+    # over a serial port, where there is no server, samples are requested.
+    # A compact subscription has the samples sent as changes, batched when the
+    # link is slow, and on reconnection catches up on those missed meanwhile.
+    def subscribe(self, compact=False):
+        self.subscription = True
+        self.compact = compact
+        if self.socket:
+            self.send(self.subscribe_message())
+            self.subscribed = True
+        return self.samples()
+
+    def subscribe_message(self):
+        if not self.compact:
+            return SUBSCRIBE_MSG + b" %d\n" % self.unit
+        message = SAMPLES_MSG + b" %d" % self.unit
+        if self.sample_time is not None:
+            message += b" %.1f" % self.sample_time
+        return message + b"\n"
+
+    def samples(self, timeout=None):
+        while True:
+            sample = self.latest(timeout)
+            yield sample
+
+    # Return the newest sample pushed since the last call, waiting up to timeout
+    # for one if none has arrived.
+    def latest(self, timeout=None):
+        if not self.subscribed:
+            return self.read(timeout)
+
+        deadline = time.time() + timeout if timeout is not None else None
+        self.receive(0)
+        while True:
+            for frame in self.decoder.frames():
+                for received in self.received(frame):
+                    if self.sample:
+                        self.skipped.append(self.sample)
+                    self.sample = received
+            if self.sample:
+                timestamp, sample = self.sample
+                self.sample = None
+                return self.observe(sample)
+
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            if not self.receive(remaining):
+                TIMEOUTS.inc()
+                raise esmartError("No data from eSmart device")
+
+
+# A group of esmart objects, one per charger, polled together so that a round
+# takes as long as the slowest charger rather than the sum of them all.
+class group:
+    def __init__(self, chargers):
+        self.chargers = chargers
+
+    def close(self):
+        for charger in self.chargers:
+            charger.close()
+
+    # Request every charger's status and return the replies in charger order,
+    # with None for any charger that did not answer within timeout.
+    def read(self, timeout=None):
+        started = time.perf_counter()
+        errors = []
+        pending = []
+        for charger in self.chargers:
+            try:
+                if not charger.connected():
+                    charger.reconnect()
+                charger.request()
+                pending.append(charger)
+            except esmartError as exception:
+                errors.append(str(exception))
+
+        samples = {}
+        deadline = time.time() + timeout if timeout is not None else None
+        while pending:
+            remaining = max(deadline - time.time(), 0) if deadline is not None else None
+            ready = select.select(pending, [], [], remaining)[0]
+            if not ready:
+                break
+            for charger in ready:
                 try:
-                    self.ser = serial.Serial(self.port,38400,timeout=0)
-                    time.sleep(0.5)
-                    if self.serial.read(100):
-                        opened = 1
-                    else:
-                        self.serial.close()
-                except serial.serialutil.SerialException:
-                    time.sleep(0.5)
-                    self.serial.close()
-            #print("Error fixed")
+                    sample = charger.poll()
+                except esmartError as exception:
+                    errors.append(str(exception))
+                    pending.remove(charger)
+                    continue
+                if sample:
+                    samples[charger] = sample
+                    pending.remove(charger)
+
+        if not samples:
+            TIMEOUTS.inc()
+            raise esmartError("No data from eSmart devices%s" % (': ' + '; '.join(errors) if errors else ''))
+        GROUP_READ_SECONDS.observe(time.perf_counter() - started)
+        return [samples.get(charger) for charger in self.chargers]
 
+    def read_aggregate(self, timeout=None):
+        return aggregate(self.read(timeout))
@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for esmart.py, heattrap.py and esmart_server.py
+#
+# Copyright (2020) Jonathan Schultz
+#
+# The eSmart3 and the Heat Trap controller are emulated over pseudo-terminals
+# and local sockets, so no hardware is needed. The fake charger answers each
+# request with a status frame after a configurable delay, optionally split into
+# fragments and preceded by noise. Results are written as JSON, and a previous
+# result file can be given to compare against.
+
+import os, sys, pty, tty, json, time, socket, random, shutil, logging, tempfile, argparse, platform, threading, subprocess, selectors
+import esmart
+import heattrap
+import recorder
+import rollup
+import replay
+
+HEATTRAP_LINE = b'THx, 1, 58, 3, 4, 5, 6, 7, 60\r\n'
+HEATTRAP_BAD_LINE = b'THx, 1, garbage\r\n'
+
+NOISE = bytes(byte for byte in range(256) if byte != 0xaa)
+
+# A status reply from the charger at address, with the fields changing a little
+# from one reply to the next. Replies for other blocks carry the same data.
+def status_frame(address=esmart.DEFAULT_ADDRESS, n=0, block=esmart.BLOCK_STATUS):
+    payload = bytearray(32)
+    esmart.STATUS_LAYOUT.pack_into(payload, esmart.STATUS_OFFSET - esmart.FRAME_HEADER_LEN,
+                                   2, 500 + n % 50, 530 + n % 10, 123, 0, 0, 650, 0, 25, 30, 90, 1)
+    return esmart.build_frame(esmart.CMD_REPLY, block, payload, address)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def pseudoterminal():
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+# Emulated eSmart3 answering requests on a file descriptor, either a pty master
+# or a socket. The noise has no start characters, since noise that happens to
+# look like a frame with a valid checksum can't be told from one.
+class fakeesmart(threading.Thread):
+    def __init__(self, fd, latency=0, fragment=0, noise=0, seed=0):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.latency = latency
+        self.fragment = fragment
+        self.noise = noise
+        self.random = random.Random(seed)
+        self.replies = 0
+
+    def run(self):
+        decoder = esmart.decoder()
+        while True:
+            try:
+                data = os.read(self.fd, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            decoder.feed(data)
+            for request in decoder.frames():
+                if request[3] != esmart.CMD_READ:
+                    continue
+                if self.latency:
+                    time.sleep(self.latency)
+                reply = bytes(self.random.choice(NOISE) for i in range(self.noise)) + status_frame(request[esmart.FRAME_ADDRESS], self.replies, request[4])
+                self.replies += 1
+                step = self.fragment or len(reply)
+                try:
+                    for start in range(0, len(reply), step):
+                        os.write(self.fd, reply[start:start + step])
+                except OSError:
+                    return
+
+# Emulated Heat Trap controller writing lines as fast as they are read, with
+# every bad_every'th line malformed.
+class fakeheattrap(threading.Thread):
+    def __init__(self, fd, lines, bad_every=0):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.lines = lines
+        self.bad_every = bad_every
+
+    def run(self):
+        block = []
+        for n in range(1, self.lines + 1):
+            block.append(HEATTRAP_BAD_LINE if self.bad_every and n % self.bad_every == 0 else HEATTRAP_LINE)
+            if len(block) == 64 or n == self.lines:
+                try:
+                    os.write(self.fd, b''.join(block))
+                except OSError:
+                    return
+                block = []
+
+# Status reads per second through esmart.read over a pty (which needs pyserial)
+# or a local socket, or given blocks, reads of them all through esmart.read_blocks.
+def bench_read(transport, count, latency, fragment, noise, blocks=None):
+    charger = esmart.esmart()
+    if transport == 'pty':
+        master, slave, name = pseudoterminal()
+        device = fakeesmart(master, latency, fragment, noise)
+        device.start()
+        charger.open(name)
+    else:
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = threading.Thread(target=charger.connect, args=(listener.getsockname(),))
+        client.start()
+        connection, address = listener.accept()
+        client.join()
+        # Send fragments as they are written rather than coalescing them
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        device = fakeesmart(connection.fileno(), latency, fragment, noise)
+        device.start()
+
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for n in range(count):
+        before = time.perf_counter()
+        try:
+            if blocks:
+                charger.read_blocks(blocks, 1)
+            else:
+                charger.read(1)
+        except esmart.esmartError:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - started
+    frames = len(latencies) * len(blocks or [esmart.BLOCK_STATUS])
+    charger.close()
+    device.join(1)
+    os.close(master) if transport == 'pty' else connection.close()
+
+    return {'frames': frames, 'errors': errors, 'seconds': elapsed, 'frames_per_sec': frames / elapsed,
+            'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99)}
+
+# Samples per second through the compact sample encoder and decoder, and the
+# bytes each sample takes when sent one per frame, as live samples usually are,
+# and in batches, as when catching up, against a status frame each.
+def bench_compact(count):
+    samples = [(1577836800.0 + 5 * n, esmart.STATUS_LAYOUT.unpack_from(status_frame(n=n), esmart.STATUS_OFFSET)) for n in range(count)]
+    encoder = esmart.sampleencoder()
+    decoder = esmart.sampledecoder()
+
+    started = time.perf_counter()
+    frames = encoder.encode(samples)
+    encoded = time.perf_counter()
+    decoded = [sample for frame in frames for sample in decoder.decode(frame)]
+    elapsed = time.perf_counter() - encoded
+    if decoded != [(round(timestamp, 1), values) for timestamp, values in samples]:
+        raise esmart.esmartError("Samples changed in encoding")
+
+    single = esmart.sampleencoder()
+    single_bytes = sum(len(single.encode([sample])[0]) for sample in samples)
+    return {'samples': count, 'encode_per_sec': count / (encoded - started), 'decode_per_sec': count / elapsed,
+            'batched_bytes_per_sample': sum(map(len, frames)) / count, 'single_bytes_per_sample': single_bytes / count,
+            'status_frame_bytes': len(status_frame())}
+
+# Samples per second recorded and rolled up, as the controller does, from units
+# chargers. Several are recorded as their aggregate status.
+def bench_record(count, units):
+    statuses = [esmart.parse(status_frame(n=n)) for n in range(count)]
+    path = tempfile.mkdtemp()
+    try:
+        store = recorder.recorder(path)
+        rollups = rollup.rollup(os.path.join(path, 'rollup'), store)
+        started = time.perf_counter()
+        for n, status in enumerate(statuses):
+            if units > 1:
+                status = esmart.aggregate([status] * units)
+            rollups.update(store.record(status, 1577836800.0 + 5 * n))
+        elapsed = time.perf_counter() - started
+        recorded = list(store.query())
+        rollups.close()
+        store.close()
+    finally:
+        shutil.rmtree(path)
+    if len(recorded) != count or recorded[-1].bat_volt != statuses[-1].bat_volt:
+        raise recorder.recorderError("Samples changed in recording")
+    return {'samples': count, 'units': units, 'records_per_sec': count / elapsed}
+
+# Decisions per second replaying a recording of samples every 5 seconds with a
+# gap of gap seconds in the middle, as when the daemon was down. Replay must
+# get through the gap without the controller failing.
+def bench_replay(count, gap):
+    path = tempfile.mkdtemp()
+    try:
+        store = recorder.recorder(path)
+        timestamp = 1577836800.0
+        for n in range(count):
+            store.record_temps([20, 40 + n % 30, 20, 20])
+            store.record(esmart.parse(status_frame(n=n)), timestamp)
+            timestamp += gap if n == count // 2 else 5
+        store.close()
+        logging.disable(logging.INFO)
+        try:
+            result = replay.replay(replay.recordedsource(path))
+        finally:
+            logging.disable(logging.NOTSET)
+    finally:
+        shutil.rmtree(path)
+    if result['restarts']:
+        raise esmart.esmartError("Controller failed %d times in replay" % result['restarts'])
+    return {'samples': count, 'gap': gap, 'decisions': result['decisions'], 'decisions_per_sec': result['decisions_per_sec']}
+
+# Lines per second through heattrap.read over a pty
+def bench_heattrap(lines, bad_every):
+    master, slave, name = pseudoterminal()
+    tank = heattrap.heattrap(name)
+    if not tank.serial:
+        raise heattrap.heattrapError("Missing module: serial")
+    device = fakeheattrap(master, lines, bad_every)
+
+    expected = lines - (lines // bad_every if bad_every else 0)
+    readings = 0
+    started = time.perf_counter()
+    device.start()
+    while readings < expected:
+        got = tank.read(1)
+        if not got and not device.is_alive() and not tank.serial.in_waiting:
+            break
+        readings += len(got)
+    elapsed = time.perf_counter() - started
+    tank.close()
+
+    return {'lines': lines, 'readings': readings, 'seconds': elapsed, 'lines_per_sec': lines / elapsed}
+
+# Requests per second and latency through esmart_server with concurrent
+# clients, each sending a status request as soon as it has the last reply.
+def bench_server(clients, seconds, latency, cache_max_age, port):
+    master, slave, name = pseudoterminal()
+    device = fakeesmart(master, latency)
+    device.start()
+
+    code = ('import asyncio, esmart_server as s; s.ESMART_DEVICES = [%r]; s.HOST = "127.0.0.1"; s.PORT = %d; '
+            's.METRICS_PORT = None; s.CACHE_MAX_AGE = %r; asyncio.run(s.main())' % (name, port, cache_max_age))
+    server = subprocess.Popen([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE)
+    try:
+        deadline = time.time() + 10
+        sockets = []
+        while not sockets:
+            try:
+                sockets = [socket.create_connection(('127.0.0.1', port)) for n in range(clients)]
+            except ConnectionRefusedError:
+                if server.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("esmart_server did not start: %s" % server.stderr.read().decode().strip().splitlines()[-1:])
+                time.sleep(0.05)
+
+        selector = selectors.DefaultSelector()
+        for connection in sockets:
+            connection.setblocking(False)
+            selector.register(connection, selectors.EVENT_READ, [esmart.decoder(), 0])
+
+        latencies = []
+        started = time.perf_counter()
+        end = started + seconds
+        for connection in sockets:
+            selector.get_key(connection).data[1] = time.perf_counter()
+            connection.send(esmart.REQUEST_MSG0)
+        while time.perf_counter() < end:
+            for key, events in selector.select(max(end - time.perf_counter(), 0)):
+                decoder, sent = key.data
+                data = key.fileobj.recv(1024)
+                if not data:
+                    raise RuntimeError("esmart_server closed the connection")
+                decoder.feed(data)
+                for frame in decoder.frames():
+                    now = time.perf_counter()
+                    latencies.append(now - sent)
+                    key.data[1] = now
+                    key.fileobj.send(esmart.REQUEST_MSG0)
+        elapsed = time.perf_counter() - started
+
+        for connection in sockets:
+            connection.close()
+    finally:
+        server.terminate()
+        server.wait()
+        os.close(master)
+
+    return {'clients': clients, 'cache_max_age': cache_max_age, 'requests': len(latencies), 'seconds': elapsed,
+            'requests_per_sec': len(latencies) / elapsed, 'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99)}
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Print the change in each throughput and latency figure from a previous run
+def compare(previous, results):
+    for name, result in results['benchmarks'].items():
+        old = previous.get('benchmarks', {}).get(name)
+        if not old:
+            continue
+        for key in sorted(result):
+            if (key.endswith('_per_sec') or key in ('p50', 'p99')) and old.get(key) and result.get(key) is not None:
+                print('%-32s %-16s %12.6g -> %12.6g  %+6.1f%%' % (name, key, old[key], result[key], (result[key] / old[key] - 1) * 100))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark esmart.py, heattrap.py and esmart_server.py against fake devices.')
+    parser.add_argument('--frames', type=int, default=2000, help='status reads for each esmart.read benchmark')
+    parser.add_argument('--latency', type=float, default=0, help='seconds the fake charger takes to reply')
+    parser.add_argument('--fragment', type=int, default=7, help='bytes per write of fragmented replies')
+    parser.add_argument('--noise', type=int, default=16, help='bytes of noise before noisy replies')
+    parser.add_argument('--lines', type=int, default=100000, help='Heat Trap lines to read')
+    parser.add_argument('--bad-every', type=int, default=10, help='make every Nth Heat Trap line malformed, 0 for none')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32], help='numbers of concurrent server clients')
+    parser.add_argument('--seconds', type=float, default=3, help='duration of each server benchmark')
+    parser.add_argument('--server-latency', type=float, default=0.02, help='seconds the fake charger behind the server takes to reply')
+    parser.add_argument('--port', type=int, default=18888, help='port for the server under test')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    results = {'time': time.time(), 'commit': commit(), 'python': platform.python_version(),
+               'machine': platform.machine(), 'benchmarks': {}}
+    benchmarks = results['benchmarks']
+
+    def run(name, function, *arguments):
+        try:
+            benchmarks[name] = function(*arguments)
+        except Exception as exception:
+            benchmarks[name] = {'error': str(exception)}
+        print('%-32s %s' % (name, json.dumps(benchmarks[name])), file=sys.stderr)
+
+    for transport in ['socket', 'pty']:
+        run('read_%s' % transport, bench_read, transport, args.frames, args.latency, 0, 0)
+        run('read_%s_fragmented_noisy' % transport, bench_read, transport, args.frames, args.latency, args.fragment, args.noise)
+        run('read_blocks_%s' % transport, bench_read, transport, args.frames // len(esmart.BLOCKS), args.latency, 0, 0, esmart.BLOCKS)
+    run('compact_samples', bench_compact, args.frames * 10)
+    for units in [1, 2]:
+        run('record_%d_units' % units, bench_record, args.frames, units)
+    run('replay_gap', bench_replay, args.frames * 10, 60)
+    run('heattrap_read', bench_heattrap, args.lines, args.bad_every)
+    for clients in args.clients:
+        run('server_%d_clients' % clients, bench_server, clients, args.seconds, args.server_latency, 1.0, args.port)
+        run('server_%d_clients_uncached' % clients, bench_server, clients, args.seconds, args.server_latency, 0, args.port)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,20 @@
 
 import esmart
 import heattrap
+import recorder
+import rollup
+import metrics
+import stats
+import snapshot
+import api
 import time
 import datetime
-from transitions import Machine
+import functools
+import json
+import heapq
+import selectors
 import sys
+import os
 import re
 import traceback
 import logging
@@ -28,22 +38,129 @@ LOW_BATTERY_TIMEOUT = 120
 CIRCULATION_DELAY_SECS = 30
 RESTART_DELAY_SECS = 300
 RETRY_SLEEP_SECS = 30
+# After a failure the controller is rebuilt at once and resumes from its
+# checkpoint, keeping the relays as they are, unless it has failed more than
+# WARM_RESTARTS times in WARM_RESTART_WINDOW seconds. Then the pumps are turned
+# off and it sleeps RETRY_SLEEP_SECS and starts again from off.
+WARM_RESTARTS = 3
+WARM_RESTART_WINDOW = 600
+WARM_RESTART_SECS = 1
 HOT_DEGREES = 59
 COLD_DEGREES = 57
 
+# Which statistic of battery voltage and charge current each threshold is
+# compared with: 'value' is the latest sample, 'mean' the exponentially
+# weighted mean over STATS_MEAN_SECS, and 'min' and 'max' are over the last
+# STATS_WINDOW_SECS. Comparing LOW_VOLT with the maximum means that the battery
+# must stay low for the whole window. Setting them all to 'value' decides on
+# each sample alone, as before.
+FULL_VOLT_STAT = 'mean'
+FULL_CUR_STAT = 'mean'
+LOW_VOLT_STAT = 'max'
+CRITICAL_VOLT_STAT = 'mean'
+STATS_MEAN_SECS = 30
+STATS_WINDOW_SECS = 60
+STATS_SLOPE_SECS = 600
+# If set, the battery is only full when its voltage, per 12V, is rising by at
+# least this many volts per hour over about STATS_SLOPE_SECS.
+FULL_MIN_SLOPE = None
+
 HEAT_PUMP_RELAY = 1
 CIRCULATION_PUMP_RELAY = 0
 
 #ESMART_HOST='containerpi4.local'
 ESMART_HOST='192.168.8.104'
 ESMART_PORT=8888
+# Addresses of the chargers on the battery bank, as numbered by esmart_server.
+# Charge decisions are made on their aggregate status.
+ESMART_UNITS=[1]
 ESMART_TIMEOUT=5
+ESMART_RETRIES=10
+# Endpoints to fail over to when esmart_server is unreachable, for example a
+# direct USB connection to the charger: ['/dev/ttyUSB0']
+ESMART_FAILOVER=[]
+# Reconnect, failing over if need be, after this many unanswered requests
+ESMART_RECONNECT_ERRORS=2
+# Without charger data for this long, wind the pumps down as when the battery
+# is critical; they start again as usual once data returns
+ESMART_BLIND_SECS=300
+# Have esmart_server push status samples rather than polling it
+ESMART_SUBSCRIBE=True
+# Have the samples sent compactly, and catch up on those missed while the link
+# was down, which are recorded when there is a single charger
+ESMART_COMPACT=False
+# Switch the chargers' load outputs off when the battery is critical, and back
+# on when it is no longer low
+LOAD_SHED=True
 
 HEATTRAP_PORT = "/dev/ttyACM0"
+HEATTRAP_RETRY_SECS = 10
+
+# Directory in which to record charger and tank samples, or None
+RECORD_PATH = "/var/lib/esmart"
+
+# File in which to keep the state, timer deadline and relays, written when they
+# change and every CHECKPOINT_SECS, or None. A controller that starts within
+# CHECKPOINT_MAX_AGE of the last write resumes from it.
+CHECKPOINT_PATH = "/var/lib/esmart/checkpoint.json"
+CHECKPOINT_SECS = 60
+CHECKPOINT_MAX_AGE = 300
+
+# File in which to publish the latest status, tank temperatures and state for
+# local readers such as snapshot.py, or None
+SNAPSHOT_PATH = "/dev/shm/esmart_fsm"
+
+# Port for the Prometheus metrics endpoint on localhost, or None
+METRICS_PORT = 9889
+
+# Address for the HTTP/JSON status and history API to listen on: localhost
+# keeps it to this machine, since it has no authentication, and '' opens it to
+# every interface
+API_HOST = 'localhost'
+# Port for the HTTP/JSON status and history API, or None
+API_PORT = 9890
+
+DWELL_BUCKETS = [30, 60, 300, 900, 1800, 3600, 7200, 14400, 28800, 86400]
+
+REPLY_TIMEOUTS = metrics.counter('esmartfsm_reply_timeouts_total', 'Rounds in which no charger answered in time')
+PARTIAL_ROUNDS = metrics.counter('esmartfsm_partial_rounds_total', 'Rounds decided without every charger answering')
+RECORD_ERRORS = metrics.counter('esmartfsm_record_errors_total', 'Samples that could not be recorded')
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 logging.getLogger('transitions').setLevel(logging.WARNING)  # Set to INFO to see transitions logging
 
+class esmartfsmError(Exception):
+    pass
+
+# Forget the checkpoint, so that the controller starts again from off
+def clear_checkpoint():
+    if CHECKPOINT_PATH:
+        try:
+            os.remove(CHECKPOINT_PATH)
+        except FileNotFoundError:
+            pass
+
+# Changes each time the machine starts, or None where it can't be read
+def boot_id():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+# Compile the states and transitions declared by a model class into a
+# (state, trigger) -> (dest, callbacks) table, checking them as we go.
+def compile_transitions(model):
+    table = {}
+    for transition in model.transitions:
+        source, trigger, dest = transition['source'], transition['trigger'], transition['dest']
+        if source not in model.states or dest not in model.states:
+            raise esmartfsmError("Unknown state in transition: %s" % transition)
+        if (source, trigger) in table:
+            raise esmartfsmError("Duplicate transition: %s" % transition)
+        table[(source, trigger)] = (dest, tuple(getattr(model, callback) for callback in transition.get('after', [])))
+    return table
+
 class esmartfsm(object):
     states  = ['off', 'on', 'starting circulation pump', 'waiting before stopping', 'stopping circulation pump low', 'waiting before restart low', 'stopping circulation pump hot', 'waiting before restart hot', 'hot']
     transitions = [
@@ -117,83 +234,504 @@ class esmartfsm(object):
         { 'source': 'hot', 'trigger': 'cold',     'dest': 'off' },
     ]
 
-    def __init__(self):
+    # The chargers, tank and relay board, the selector and the clock can be given,
+    # as replay.py does to run the controller against recorded or simulated data.
+    def __init__(self, chargers=None, tank=None, piface=None, clock=time.time, selector=None):
 
-        self.piface = pifacedigitalio.PiFaceDigital() if 'pifacedigitalio' in sys.modules else None
+        self.clock = clock
+        checkpoint = self.load_checkpoint()
 
-        self.turn_heat_pump_off()
-        self.turn_circulation_pump_off()
+        if piface:
+            self.piface = piface
+        elif 'pifacedigitalio' in sys.modules:
+            # Setting the board up turns the relays off, so when resuming leave
+            # it as it is unless the machine has restarted since.
+            self.piface = pifacedigitalio.PiFaceDigital(init_board=not (checkpoint and checkpoint.get('boot') == boot_id()))
+        else:
+            self.piface = None
 
-        self.heattrap = heattrap.heattrap(HEATTRAP_PORT)
+        if not checkpoint:
+            self.turn_heat_pump_off()
+            self.turn_circulation_pump_off()
 
-        self.esmart = esmart.esmart()
-        self.esmart.connect((ESMART_HOST, ESMART_PORT))
+        self.heattrap = tank
 
-        self.machine = Machine(model=self, states=esmartfsm.states, transitions=esmartfsm.transitions, initial='off')
+        self.recorder = recorder.recorder(RECORD_PATH) if RECORD_PATH else None
+        self.rollup = rollup.rollup(os.path.join(RECORD_PATH, 'rollup'), self.recorder) if RECORD_PATH else None
+        self.snapshot = snapshot.publisher(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
 
-        self.ticker = 0
+        if chargers:
+            self.chargers = chargers
+        else:
+            self.chargers = []
+            for unit in ESMART_UNITS:
+                charger = esmart.esmart(unit)
+                charger.endpoints = [(ESMART_HOST, ESMART_PORT)] + ESMART_FAILOVER
+                self.chargers.append(charger)
+        if ESMART_SUBSCRIBE:
+            for charger in self.chargers:
+                charger.subscribe(ESMART_COMPACT)
+        # The latest status from each charger in the current round
+        self.samples = {}
+        # The latest decided status and tank temperatures with their times, for
+        # the API, which reads them from another thread
+        self.status = None
+        self.temps = None
+        self.load_shed = False
+        # Only the statistics that the thresholds use are kept, and the mean for logging
+        self.bat_volt = stats.signal(STATS_MEAN_SECS, STATS_WINDOW_SECS, STATS_SLOPE_SECS,
+                                     {'mean', FULL_VOLT_STAT, LOW_VOLT_STAT, CRITICAL_VOLT_STAT} | ({'slope'} if FULL_MIN_SLOPE is not None else set()))
+        self.chg_cur = stats.signal(STATS_MEAN_SECS, STATS_WINDOW_SECS, STATS_SLOPE_SECS, {FULL_CUR_STAT})
+
+        self.state = 'off'
+        self.entered = self.clock()
+        metrics.gauge('esmartfsm_state_seconds', 'Time in the current state', function=lambda: self.clock() - self.entered)
+        for state in self.states:
+            metrics.gauge('esmartfsm_state', 'Current state', {'state': state}, lambda state=state: int(self.state == state))
+
+        # Timers are [deadline, sequence, callback] entries in a heap; a cancelled
+        # timer has its callback cleared and is discarded when it reaches the top.
+        self.timers = []
+        self.sequence = 0
         self.timer = None
-
-    def request_data(self):
-        if self.timer and time.time() >= self.timer:
-            logging.info('DELAY EXPIRED')
-            self.timer = None
-            self.timeout()
+        self.fsm_timer = None
+        self.reply_timer = None
+        self.connect_timers = {}
+        self.esmart_errors = 0
+        self.decided_at = self.clock()
+        self.checkpointed = None
+
+        if checkpoint:
+            self.resume(checkpoint)
+        if self.snapshot:
+            self.snapshot.publish_state(self.state)
+
+        self.selector = selector or selectors.DefaultSelector()
+        if self.heattrap:
+            try:
+                self.selector.register(self.heattrap, selectors.EVENT_READ, self.on_heattrap)
+            except heattrap.heattrapError as exception:
+                logging.info(exception)
         else:
-            timebefore = time.time()
-            tempsensors = self.heattrap.read(self.ticker)
-            self.ticker -= time.time() - timebefore
-            if self.ticker < 0:
-                self.ticker = 0
-            if tempsensors:
-
-                def log_temp_sensors(status):
-                    logging.info('Temperature sensors: %s - %s' % (tempsensors, status))
-
-                if tempsensors[1] >= HOT_DEGREES:
-                    log_temp_sensors('HOT')
-                    self.hot()
-                elif tempsensors[1] <= COLD_DEGREES:
-                    log_temp_sensors('COLD')
-                    self.cold()
-                else:
-                    log_temp_sensors('')
+            self.open_heattrap()
+        for charger in self.chargers:
+            if chargers:
+                self.selector.register(charger, selectors.EVENT_READ, functools.partial(self.on_esmart, charger))
+            else:
+                self.connect_esmart(charger)
+        self.api = api.serve(API_PORT, self, API_HOST) if API_PORT else None
+        self.poll_timer = self.schedule(0, self.on_poll)
+
+    def trigger(self, trigger):
+        try:
+            dest, callbacks = esmartfsm.table[(self.state, trigger)]
+        except KeyError:
+            raise esmartfsmError("Can't trigger event %s from state %s!" % (trigger, self.state))
+        TRIGGER_COUNTS[trigger].inc()
+        changed = dest != self.state
+        if changed:
+            now = self.clock()
+            STATE_DWELL[self.state].observe(now - self.entered)
+            self.entered = now
+            if self.snapshot:
+                self.snapshot.publish_state(dest)
+        self.state = dest
+        for callback in callbacks:
+            callback(self)
+        # Callbacks set timers and relays, so they are saved too
+        if changed or callbacks:
+            self.save_checkpoint()
+        return True
+
+    def full(self):
+        return self.trigger('full')
+
+    def low(self):
+        return self.trigger('low')
+
+    def critical(self):
+        return self.trigger('critical')
+
+    def tick(self):
+        return self.trigger('tick')
+
+    def hot(self):
+        return self.trigger('hot')
+
+    def cold(self):
+        return self.trigger('cold')
+
+    def timeout(self):
+        return self.trigger('timeout')
+
+    def schedule(self, delay, callback):
+        self.sequence += 1
+        entry = [self.clock() + delay, self.sequence, callback]
+        heapq.heappush(self.timers, entry)
+        return entry
+
+    def cancel(self, entry):
+        if entry:
+            entry[2] = None
+
+    # Wait for the next event or timer and dispatch it
+    def step(self):
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        timeout = max(self.timers[0][0] - self.clock(), 0) if self.timers else None
+
+        for key, events in self.selector.select(timeout):
+            key.data()
+
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            deadline, sequence, callback = heapq.heappop(self.timers)
+            if callback:
+                callback()
+
+    def run(self):
+        while True:
+            self.step()
+
+    # Open the Heat Trap port, trying again every HEATTRAP_RETRY_SECS until it
+    # opens, while the controller carries on without temperatures
+    def open_heattrap(self):
+        try:
+            self.heattrap = heattrap.heattrap(HEATTRAP_PORT)
+        except OSError as exception:
+            logging.info("Can't open Heat Trap %s: %s" % (HEATTRAP_PORT, exception))
+            self.schedule(HEATTRAP_RETRY_SECS, self.open_heattrap)
+            return
+        try:
+            self.selector.register(self.heattrap, selectors.EVENT_READ, self.on_heattrap)
+        except heattrap.heattrapError as exception:
+            logging.info(exception)
+
+    def on_heattrap(self):
+        try:
+            readings = self.heattrap.read(0)
+        except OSError as exception:
+            logging.info('Lost Heat Trap: %s' % exception)
+            self.selector.unregister(self.heattrap)
+            self.heattrap.close()
+            self.heattrap = None
+            # Record no tank readings until it is back, rather than the last ones
+            if self.recorder:
+                self.recorder.record_temps(None)
+            self.schedule(HEATTRAP_RETRY_SECS, self.open_heattrap)
+            return
+
+        for tempsensors in readings:
+            if self.recorder:
+                self.recorder.record_temps(tempsensors)
+            if self.snapshot:
+                self.snapshot.publish_temps(tempsensors)
+            self.temps = (time.time(), tempsensors)
+
+            def log_temp_sensors(status):
+                logging.info('Temperature sensors: %s - %s' % (tempsensors, status))
+
+            if tempsensors[1] >= HOT_DEGREES:
+                log_temp_sensors('HOT')
+                self.hot()
+            elif tempsensors[1] <= COLD_DEGREES:
+                log_temp_sensors('COLD')
+                self.cold()
             else:
-                if self.ticker == 0:
-                    n = 10
-                    while n > 0:
-                        try:
-                            data = self.esmart.read(ESMART_TIMEOUT)
-                            break
-                        except esmart.esmartError as exception:
-                            logging.info(exception)
-                            n -= 1
-                            
-                    if n == 0:
-                        raise RuntimeError('Too many eSmart errors.')
-
-                    charge_mode = esmart.DEVICE_MODE[data['chg_mode']]
-
-                    def log_charge_status(status):
-                        logging.info('Charge mode: %s Battery %.1fV %.1fA - %s' % (charge_mode, data['bat_volt'], data['chg_cur'], status))
-
-                    if ( (     charge_mode == 'FLOAT' 
-                          or ( charge_mode == 'CV' and data['bat_volt'] >= FULL_VOLT_CV * CELLS / 6 ) 
-                          or                           data['bat_volt'] >= FULL_VOLT * CELLS / 6 ) 
-                    and data['chg_cur'] < FULL_POWER / (CELLS * 2.0) ):
-                        log_charge_status('FULL')
-                        self.full()
-                    elif data['bat_volt'] < CRITICAL_VOLT * CELLS / 6:
-                        log_charge_status('CRITICAL')
-                        self.critical()
-                    elif data['bat_volt'] < LOW_VOLT * CELLS / 6:
-                        log_charge_status('LOW')
-                        self.low()
-                    else:
-                        log_charge_status('TICK')
-                        self.tick()
-
-                    self.ticker = TICK_SECS
+                log_temp_sensors('')
+
+    # Connections to esmart_server are made without blocking: the charger is
+    # watched until it is writable, and the next endpoint tried if it is not
+    # within CONNECT_TIMEOUT. Each charger has at most one timer for this or
+    # for the next attempt, so that attempts never overlap.
+    def connect_esmart(self, charger):
+        self.cancel(self.connect_timers.pop(charger, None))
+        try:
+            endpoint = charger.reconnect(wait=False)
+        except esmart.esmartError as exception:
+            self.esmart_unreachable(charger, exception)
+            return
+        self.esmart_connecting(charger, endpoint)
+
+    def esmart_connecting(self, charger, endpoint):
+        if endpoint is None:
+            self.selector.register(charger, selectors.EVENT_WRITE, functools.partial(self.on_esmart_connect, charger))
+            self.connect_timers[charger] = self.schedule(esmart.CONNECT_TIMEOUT, functools.partial(self.on_esmart_connect, charger, True))
+            return
+        logging.info('CONNECTED TO ESMART %s UNIT %d' % (endpoint, charger.unit))
+        self.selector.register(charger, selectors.EVENT_READ, functools.partial(self.on_esmart, charger))
+
+    def on_esmart_connect(self, charger, timed_out=False):
+        self.selector.unregister(charger)
+        self.cancel(self.connect_timers.pop(charger, None))
+        try:
+            endpoint = charger.abandon_connect() if timed_out else charger.finish_connect()
+        except esmart.esmartError as exception:
+            self.esmart_unreachable(charger, exception)
+            return
+        self.esmart_connecting(charger, endpoint)
+
+    def esmart_unreachable(self, charger, exception):
+        logging.info(exception)
+        self.connect_timers[charger] = self.schedule(charger.retry_delay(), functools.partial(self.connect_esmart, charger))
+
+    # Drop the connection and reconnect at once, failing over if need be
+    def reconnect_esmart(self, charger, exception):
+        logging.info(exception)
+        try:
+            self.selector.unregister(charger)
+        except (KeyError, ValueError):
+            pass
+        charger.close()
+        self.connect_esmart(charger)
+
+    # Ask the chargers for their status every TICK_SECS, all at once so that the
+    # round takes as long as the slowest. When subscribed the server sends it
+    # anyway, so just check that it keeps doing so.
+    def on_poll(self):
+        self.poll_timer = self.schedule(TICK_SECS, self.on_poll)
+        if self.checkpointed is None or self.clock() - self.checkpointed >= CHECKPOINT_SECS:
+            self.save_checkpoint()
+        for charger in self.chargers:
+            self.request_esmart(charger)
+        if not self.reply_timer:
+            self.reply_timer = self.schedule(ESMART_TIMEOUT, self.on_reply_timeout)
+
+    def request_esmart(self, charger):
+        if not charger.connected() or charger.subscribed:
+            return
+        if not charger.healthy():
+            self.reconnect_esmart(charger, 'eSmart device is not responding')
+            return
+        try:
+            charger.request()
+        except esmart.esmartError as exception:
+            self.reconnect_esmart(charger, exception)
+
+    # If only some chargers have answered, decide on those rather than not at all
+    def on_reply_timeout(self):
+        self.reply_timer = None
+        if self.samples:
+            missing = [charger.unit for charger in self.chargers if charger not in self.samples]
+            logging.info('No data from eSmart unit %s' % ', '.join(str(unit) for unit in missing))
+            PARTIAL_ROUNDS.inc()
+            self.decide()
+            return
+
+        logging.info('No data from eSmart device')
+        REPLY_TIMEOUTS.inc()
+        self.esmart_errors += 1
+        if self.clock() - self.decided_at >= ESMART_BLIND_SECS:
+            logging.info('NO ESMART DATA FOR %ds' % (self.clock() - self.decided_at))
+            self.critical()
+
+        # Start the connections again from scratch after too many errors, rather
+        # than the whole controller
+        reinitialize = self.esmart_errors >= ESMART_RETRIES
+        if reinitialize:
+            logging.info('Too many eSmart errors.')
+            self.esmart_errors = 0
+        for charger in self.chargers:
+            if reinitialize or (self.esmart_errors % ESMART_RECONNECT_ERRORS == 0 and charger.connected()):
+                self.reconnect_esmart(charger, 'Reconnecting to eSmart device')
+            self.request_esmart(charger)
+        self.reply_timer = self.schedule(ESMART_TIMEOUT, self.on_reply_timeout)
+
+    def on_esmart(self, charger):
+        try:
+            data = charger.poll()
+        except esmart.esmartError as exception:
+            self.reconnect_esmart(charger, exception)
+            return
+        if not data:
+            return
+        if self.recorder and len(self.chargers) == 1:
+            self.record_missed(charger)
+
+        self.samples[charger] = data
+        if len(self.samples) == len(self.chargers):
+            self.decide()
+
+    # Record the samples caught up on since the last one recorded. Compact samples
+    # carry the server's times, so they are moved onto this clock by the offset
+    # of the newest, which is about to be recorded now, and any that would not
+    # fall between the last sample recorded and now are dropped, since the
+    # recorder and rollups need times that only increase.
+    def record_missed(self, charger):
+        missed = charger.missed()
+        if not missed:
+            return
+        now = time.time()
+        offset = now - charger.sample_time if charger.compact and charger.sample_time is not None else 0
+        after = self.status[0] if self.status else 0
+        for timestamp, sample in missed:
+            timestamp += offset
+            if after < timestamp < now:
+                if not self.record(sample, timestamp):
+                    return
+                after = timestamp
+
+    # Recording is only for looking back on, so a sample that can't be recorded,
+    # as when the disk is full, is logged and the controller carries on.
+    def record(self, status, timestamp):
+        try:
+            self.rollup.update(self.recorder.record(status, timestamp))
+        except (OSError, recorder.recorderError) as exception:
+            logging.info('Failed to record sample: %s' % exception)
+            RECORD_ERRORS.inc()
+            return False
+        return True
+
+    # Classify the aggregate status of the chargers that have answered this round
+    def decide(self):
+        data = esmart.aggregate(self.samples.values()) if len(self.chargers) > 1 else self.samples[self.chargers[0]]
+        if self.snapshot:
+            self.snapshot.publish_status(data, len(self.samples))
+        self.samples = {}
+        self.esmart_errors = 0
+        self.decided_at = self.clock()
+        self.cancel(self.reply_timer)
+        self.reply_timer = None
+
+        self.status = (time.time(), data)
+        if self.recorder:
+            self.record(data, self.status[0])
+
+        charge_mode = esmart.DEVICE_MODE[data['chg_mode']]
+
+        now = self.clock()
+        self.bat_volt.update(now, data['bat_volt'])
+        self.chg_cur.update(now, data['chg_cur'])
+        full_volt = self.bat_volt.get(FULL_VOLT_STAT)
+        full_cur = self.chg_cur.get(FULL_CUR_STAT)
+        rising = FULL_MIN_SLOPE is None or self.bat_volt.slope >= FULL_MIN_SLOPE * CELLS / 6
+
+        def log_charge_status(status):
+            trend = ' (mean %.1fV)' % self.bat_volt.mean if FULL_MIN_SLOPE is None else ' (mean %.1fV %+.2fV/h)' % (self.bat_volt.mean, self.bat_volt.slope)
+            if len(self.chargers) > 1:
+                logging.info('Charge mode: %s Battery %.1f-%.1fV%s %.1fA %dW from %d units - %s' % (charge_mode, data['bat_volt_min'], data['bat_volt_max'], trend, data['chg_cur'], data['chg_power'], data['units'], status))
+            else:
+                logging.info('Charge mode: %s Battery %.1fV%s %.1fA - %s' % (charge_mode, data['bat_volt'], trend, data['chg_cur'], status))
+
+        if ( (     charge_mode == 'FLOAT' 
+              or ( charge_mode == 'CV' and full_volt >= FULL_VOLT_CV * CELLS / 6 ) 
+              or                           full_volt >= FULL_VOLT * CELLS / 6 ) 
+        and full_cur < FULL_POWER / (CELLS * 2.0) and rising ):
+            log_charge_status('FULL')
+            self.restore_load()
+            self.full()
+        elif self.bat_volt.get(CRITICAL_VOLT_STAT) < CRITICAL_VOLT * CELLS / 6:
+            log_charge_status('CRITICAL')
+            self.shed_load()
+            self.critical()
+        elif self.bat_volt.get(LOW_VOLT_STAT) < LOW_VOLT * CELLS / 6:
+            log_charge_status('LOW')
+            self.low()
+        else:
+            log_charge_status('TICK')
+            self.restore_load()
+            self.tick()
+
+    # Repeated requests for the same load state are coalesced by the chargers,
+    # so the load is asked to be off on every critical status.
+    def shed_load(self):
+        if not LOAD_SHED:
+            return
+        if not self.load_shed:
+            logging.info('SHEDDING LOAD')
+            self.load_shed = True
+            self.save_checkpoint()
+        self.set_load(False)
+
+    # Only a load that was shed is switched back on
+    def restore_load(self):
+        if self.load_shed:
+            logging.info('RESTORING LOAD')
+            self.load_shed = False
+            self.save_checkpoint()
+            self.set_load(True)
+
+    def set_load(self, on):
+        for charger in self.chargers:
+            try:
+                charger.set_load(on)
+            except esmart.esmartError as exception:
+                self.reconnect_esmart(charger, exception)
+
+    # Close the devices and files, leaving the relays as they are
+    def close(self):
+        if self.api:
+            self.api.shutdown()
+            self.api.server_close()
+        for charger in self.chargers:
+            charger.close()
+        if self.heattrap:
+            self.heattrap.close()
+        for store in (self.rollup, self.recorder, self.snapshot):
+            if store:
+                store.close()
+        self.selector.close()
+
+    def relays(self):
+        if not self.piface:
+            return None
+        return {'heat_pump': self.piface.relays[HEAT_PUMP_RELAY].value,
+                'circulation_pump': self.piface.relays[CIRCULATION_PUMP_RELAY].value}
+
+    # Write the checkpoint to a new file and rename it over the old, so that a
+    # crash part way through leaves the old one intact
+    def save_checkpoint(self):
+        self.checkpointed = self.clock()
+        if not CHECKPOINT_PATH:
+            return
+        checkpoint = {'time': self.checkpointed, 'boot': boot_id(), 'state': self.state, 'entered': self.entered,
+                      'timer': self.timer, 'relays': self.relays(), 'load_shed': self.load_shed}
+        temporary = CHECKPOINT_PATH + '.tmp'
+        try:
+            with open(temporary, 'w') as file:
+                json.dump(checkpoint, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, CHECKPOINT_PATH)
+        except OSError as exception:
+            logging.info("Can't write checkpoint: %s" % exception)
+
+    def load_checkpoint(self):
+        if not CHECKPOINT_PATH:
+            return None
+        try:
+            with open(CHECKPOINT_PATH) as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if checkpoint.get('state') not in self.states or self.clock() - checkpoint.get('time', 0) > CHECKPOINT_MAX_AGE:
+            return None
+        return checkpoint
+
+    # Carry on from a checkpoint. A timer that has expired meanwhile fires at once.
+    def resume(self, checkpoint):
+        logging.info('RESUMING IN STATE %s' % checkpoint['state'].upper())
+        self.state = checkpoint['state']
+        self.entered = checkpoint['entered']
+        self.load_shed = checkpoint.get('load_shed', False)
+        relays = checkpoint.get('relays')
+        if self.piface and relays:
+            self.piface.relays[HEAT_PUMP_RELAY].value = relays['heat_pump']
+            self.piface.relays[CIRCULATION_PUMP_RELAY].value = relays['circulation_pump']
+        if checkpoint.get('timer') is not None:
+            self.timer = checkpoint['timer']
+            self.fsm_timer = self.schedule(self.timer - self.clock(), self.on_timer)
+
+    def on_timer(self):
+        logging.info('DELAY EXPIRED')
+        self.timer = None
+        self.fsm_timer = None
+        self.timeout()
+
+    def set_timer(self, delay):
+        self.cancel(self.fsm_timer)
+        self.fsm_timer = self.schedule(delay, self.on_timer)
+        self.timer = self.fsm_timer[0]
 
     def turn_heat_pump_on(self):
         logging.info('TURN HEAT PUMP ON')
@@ -202,7 +740,7 @@ class esmartfsm(object):
 
     def set_circulation_delay_timer(self):
         logging.info('SET CIRCULATION DELAY TIMER')
-        self.timer = time.time() + CIRCULATION_DELAY_SECS
+        self.set_timer(CIRCULATION_DELAY_SECS)
 
     def turn_circulation_pump_on(self):
         logging.info('TURN CIRCULATION PUMP ON')
@@ -221,35 +759,74 @@ class esmartfsm(object):
 
     def set_restart_delay_timer(self):
         logging.info('SET RESTART DELAY TIMER')
-        self.timer = time.time() + RESTART_DELAY_SECS
+        self.set_timer(RESTART_DELAY_SECS)
 
     def set_low_battery_timer(self):
         logging.info('SET LOW BATTERY TIMER')
-        self.timer = time.time() + LOW_BATTERY_TIMEOUT
+        self.set_timer(LOW_BATTERY_TIMEOUT)
 
     def cancel_timer(self):
         logging.info('CANCELLING TIMER')
+        self.cancel(self.fsm_timer)
+        self.fsm_timer = None
         self.timer = None
 
-fsm = None
-logging.info('STARTING DAEMON')
-while True:
-    try:
-        if not fsm:
-            fsm = esmartfsm()
-        fsm.request_data()
-
-    except Exception as exception:
-        if fsm:
-            fsm.turn_heat_pump_off()
-            fsm.turn_circulation_pump_off()
-            fsm.piface.deinit_board()
-            del(fsm.piface)
-            del(fsm)
-            fsm = None
-
-        logging.info(traceback.format_exc())
-        logging.info(exception)
-        logging.info('SLEEPING BEFORE RETRYING')
-        time.sleep(RETRY_SLEEP_SECS)
-        continue
+esmartfsm.table = compile_transitions(esmartfsm)
+
+STATE_DWELL = {state: metrics.histogram('esmartfsm_state_dwell_seconds', 'Time spent in a state before leaving it', {'state': state}, DWELL_BUCKETS) for state in esmartfsm.states}
+TRIGGER_COUNTS = {trigger: metrics.counter('esmartfsm_triggers_total', 'Events by trigger', {'trigger': trigger}) for source, trigger in esmartfsm.table}
+
+# Draw the state diagram. Only this needs the transitions package (and pygraphviz),
+# so it is imported here rather than when the daemon starts.
+def draw(filename, initial='off'):
+    from transitions.extensions import GraphMachine
+    machine = GraphMachine(states=esmartfsm.states, transitions=esmartfsm.transitions, initial=initial)
+    machine.get_graph().draw(filename, prog='dot')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--diagram':
+        draw(sys.argv[2])
+        sys.exit(0)
+
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+
+    fsm = None
+    piface = None
+    failures = []
+    logging.info('STARTING DAEMON')
+    while True:
+        try:
+            if not fsm:
+                fsm = esmartfsm(piface=piface)
+            fsm.run()
+
+        except Exception as exception:
+            logging.info(traceback.format_exc())
+            logging.info(exception)
+
+            now = time.time()
+            failures = [failure for failure in failures if now - failure < WARM_RESTART_WINDOW] + [now]
+            if fsm:
+                piface = fsm.piface
+                fsm.close()
+                fsm = None
+
+            if len(failures) <= WARM_RESTARTS:
+                # Keep the relay board, and the relays as they are
+                logging.info('RESTARTING FROM CHECKPOINT')
+                time.sleep(WARM_RESTART_SECS)
+                continue
+
+            if piface:
+                logging.info('TURN HEAT PUMP OFF')
+                piface.relays[HEAT_PUMP_RELAY].value = 0
+                logging.info('TURN CIRCULATION PUMP OFF')
+                piface.relays[CIRCULATION_PUMP_RELAY].value = 0
+                piface.deinit_board()
+                piface = None
+            clear_checkpoint()
+            logging.info('SLEEPING BEFORE RETRYING')
+            time.sleep(RETRY_SLEEP_SECS)
+            failures = []
+            continue
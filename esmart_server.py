@@ -7,91 +7,488 @@
 #
 
 import serial
-import socket
-import select
-import queue
+import asyncio
+import sys
+import collections
+import time
+import struct
+import esmart
+import metrics
+import snapshot
+try:
+    import fcntl
+    import termios
+except ModuleNotFoundError:
+    pass
 
 HOST=''
 PORT=8888
 ESMART="/dev/ttyUSB{}"
+# Serial devices to serve, or empty to serve every ESMART device found. Each is
+# given an address, from 1 in this order, which clients put in byte 1 of their
+# requests to choose the charger.
+ESMART_DEVICES=[]
+SERIAL_TIMEOUT=0.5
 
-n = 0
-while True:
-    try:
-        serdevice = ESMART.format(n)
-        ser = serial.Serial(serdevice, 9600, timeout=0.1)
-        break
-    except serial.serialutil.SerialException:
-        n += 1
-        if n == 10: # Arbitrary
-            raise RuntimeError('Can''t connect to eSmart.')
-
-server = socket.socket()
-server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server.bind((HOST, PORT))
-server.listen(5)
-
-inputs = [server]
-outputs = []
-message_queues = {}
-
-while inputs:
-    readable, writable, exceptional = select.select(inputs, outputs, inputs)
-    for s in readable:
-        if s is server:
-            connection, client_address = s.accept()
-            connection.setblocking(0)
-            inputs.append(connection)
-            message_queues[connection] = queue.Queue()
+# Replies to status and other read requests are reused for this many seconds,
+# so that several clients polling at once cost a single serial round trip.
+CACHE_MAX_AGE=1.0
+CACHEABLE_COMMANDS=[esmart.CMD_READ]
+
+# Maximum number of replies queued for a client before it is disconnected
+CLIENT_QUEUE=16
+
+# While any client is subscribed, the charger is polled at this interval and
+# each status frame is sent to every subscriber.
+SUBSCRIBE_SECS=5
+
+# Polled samples kept for compact subscribers to catch up on when they
+# reconnect. Polling carries on for as long as the ring covers after the last
+# compact subscriber leaves, so that it has something to catch up on.
+RING_SAMPLES=720
+# While earlier data to a compact subscriber is unacknowledged, new samples are
+# held back for up to this long to go together
+COMPACT_BATCH_SECS=10
+COMPACT_CHECK_SECS=0.05
+
+# Clients can send this instead of an eSmart frame to read the cache counters.
+# Commands such as this end with a newline, and may come before or after frames.
+STATS_MSG=b"STATS"
+COMMAND_MAX=64
+
+# Port for the Prometheus metrics endpoint on localhost, or None
+METRICS_PORT=9888
+
+# File in which to publish the latest status of the chargers for local readers
+# such as snapshot.py, or None
+SNAPSHOT_PATH="/dev/shm/esmart_server"
+
+CLIENTS = metrics.gauge('esmart_server_clients', 'Connected clients')
+
+def cacheable(request):
+    return request[3] in CACHEABLE_COMMANDS
+
+class replycache:
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.replies = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, request):
+        if not cacheable(request):
+            return None
+        if request in self.replies:
+            timestamp, reply = self.replies[request]
+            if time.time() - timestamp < self.max_age:
+                self.hits += 1
+                return reply
+        return None
+
+    def put(self, request, reply):
+        if cacheable(request):
+            self.replies[request] = (time.time(), reply)
+
+    def invalidate(self):
+        self.replies.clear()
+
+    def stats(self):
+        return b"hits=%d misses=%d coalesced=%d max_age=%g\n" % (self.hits, self.misses, self.coalesced, self.max_age)
+
+def open_serials():
+    serials = []
+    for serdevice in ESMART_DEVICES or [ESMART.format(n) for n in range(10)]: # Arbitrary
+        try:
+            serials.append((serdevice, serial.Serial(serdevice, 9600, timeout=0)))
+        except serial.serialutil.SerialException:
+            if ESMART_DEVICES:
+                raise RuntimeError('Can''t connect to eSmart %s.' % serdevice)
+    if not serials:
+        raise RuntimeError('Can''t connect to eSmart.')
+    return serials
+
+# Bytes written to a client that it has not acknowledged, counting those the
+# kernel has yet to send, where the platform can say
+def unacknowledged(writer):
+    size = writer.transport.get_write_buffer_size()
+    sock = writer.get_extra_info('socket')
+    if 'fcntl' in sys.modules and sock:
+        try:
+            size += struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b'\0' * 4))[0]
+        except OSError:
+            pass
+    return size
+
+# A client's compact subscription to one charger. New samples wait here until
+# the client's sender gets to them. While the link is still busy with what was
+# sent before, the sender waits and the samples build up, and all those waiting
+# then go in one write, so a slow link carries fewer, larger packets.
+class compactsubscriber:
+    def __init__(self, dev, outgoing):
+        self.dev = dev
+        self.outgoing = outgoing
+        self.encoder = esmart.sampleencoder()
+        self.pending = collections.deque(maxlen=RING_SAMPLES)
+        self.queued = False
+
+    def add(self, samples):
+        self.pending.extend(samples)
+        # If the queue is full, the samples go with the next ones
+        if not self.queued and not self.outgoing.full():
+            self.outgoing.put_nowait(self)
+            self.queued = True
+
+    async def wait(self, writer):
+        deadline = time.time() + COMPACT_BATCH_SECS
+        while unacknowledged(writer) and time.time() < deadline:
+            await asyncio.sleep(COMPACT_CHECK_SECS)
+
+    def flush(self):
+        self.queued = False
+        frames = self.encoder.encode(self.pending, self.dev.address)
+        self.dev.compact_samples.inc(len(self.pending))
+        self.dev.compact_frames.inc(len(frames))
+        self.pending.clear()
+        return b''.join(frames)
+
+def reopen_serial(serdevice):
+    n = 0
+    while True:
+        try:
+            return serial.Serial(serdevice, 9600, timeout=0)
+        except serial.serialutil.SerialException:
+            n += 1
+            if n == 10: # Arbitrary
+                raise RuntimeError('Can''t connect to eSmart.')
+
+# A serial device. A single worker task owns the serial port and takes requests
+# from a queue one at a time, so clients never block each other. Each device has
+# its own worker, so several chargers are polled at the same time.
+class device:
+    def __init__(self, serdevice, ser, cache, address=esmart.DEFAULT_ADDRESS):
+        self.serdevice = serdevice
+        self.address = address
+        self.ser = None
+        self.cache = cache
+        self.requests = asyncio.Queue()
+        self.inflight = {}
+        self.decoder = esmart.decoder()
+        self.received = b''
+        self.readable = asyncio.Event()
+        self.subscribers = set()
+        self.subscribed = asyncio.Event()
+        self.compact = set()
+        self.ring = collections.deque(maxlen=RING_SAMPLES)
+        self.retain_until = 0
+        # The latest status read from the charger, and a function called with it
+        self.status = None
+        self.on_status = None
+
+        labels = {'device': serdevice}
+        self.transact_seconds = metrics.histogram('esmart_server_transact_seconds', 'Serial round trip time', labels)
+        self.timeouts = metrics.counter('esmart_server_timeouts_total', 'Requests without a complete reply in time', labels)
+        self.reopens = metrics.counter('esmart_server_serial_reopens_total', 'Times the serial port was reopened', labels)
+        metrics.gauge('esmart_server_queue_length', 'Requests waiting for the serial port', labels, self.requests.qsize)
+        metrics.gauge('esmart_server_subscribers', 'Subscribed clients', labels, lambda: len(self.subscribers))
+        metrics.counter('esmart_server_cache_hits_total', 'Requests answered from the cache', labels, lambda: self.cache.hits)
+        metrics.counter('esmart_server_cache_misses_total', 'Cacheable requests sent to the charger', labels, lambda: self.cache.misses)
+        metrics.counter('esmart_server_cache_coalesced_total', 'Requests that shared a round trip in progress', labels, lambda: self.cache.coalesced)
+        self.compact_samples = metrics.counter('esmart_server_compact_samples_total', 'Samples sent to compact subscribers', labels)
+        self.compact_frames = metrics.counter('esmart_server_compact_frames_total', 'Frames of samples sent to compact subscribers', labels)
+        self.attach(ser)
+
+    def attach(self, ser):
+        self.ser = ser
+        asyncio.get_event_loop().add_reader(ser.fileno(), self.on_readable)
+
+    def detach(self):
+        if self.ser:
+            asyncio.get_event_loop().remove_reader(self.ser.fileno())
+            self.ser.close()
+            self.ser = None
+
+    def on_readable(self):
+        try:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.serialutil.SerialException, OSError):
+            self.detach()
+            data = None
+        if data:
+            self.received += data
+            self.decoder.feed(data)
+        self.readable.set()
+
+    # Give a reply this device's address, so clients can tell the chargers apart
+    def addressed(self, reply):
+        if reply[0] == 0xaa and not sum(reply) & 0xff:
+            return esmart.readdress(reply, self.address)
+        return reply
+
+    async def reopen(self):
+        # https://stackoverflow.com/questions/33441579/io-error-errno-5-with-long-term-serial-connection-in-python
+        self.detach()
+        self.reopens.inc()
+        ser = await asyncio.get_event_loop().run_in_executor(None, reopen_serial, self.serdevice)
+        self.attach(ser)
+
+    # Queue a request for the worker and wait for its reply. Cacheable requests
+    # are answered from the cache, unless cached is false, or share a round trip
+    # already in progress.
+    async def request(self, request, cached=True):
+        reply = self.cache.get(request) if cached else None
+        if reply is not None:
+            return reply
+
+        future = self.inflight.get(request)
+        if future:
+            self.cache.coalesced += 1
         else:
+            future = asyncio.get_event_loop().create_future()
+            if cacheable(request):
+                # Misses count round trips to the charger, not requests
+                self.cache.misses += 1
+                self.inflight[request] = future
+            self.requests.put_nowait((request, future))
+        return await asyncio.shield(future)
+
+    async def worker(self):
+        while True:
+            request, future = await self.requests.get()
             try:
-                data = s.recv(1024)
-            except ConnectionResetError:
-                data = None
-
-            if data:
-                try:
-                    ser.write(data)
-                except (serial.serialutil.SerialException, OSError):
-                    # https://stackoverflow.com/questions/33441579/io-error-errno-5-with-long-term-serial-connection-in-python
-                    ser.close()
-
-                    n = 0
-                    while True:
-                        try:
-                            ser = serial.Serial(serdevice, 9600, timeout=0.1)
-                            break
-                        except serial.serialutil.SerialException:
-                            n += 1
-                            if n == 10: # Arbitrary
-                                raise RuntimeError('Can''t connect to eSmart.')
-
-                    ser.write(data)
-
-                reply = ser.read(1024)
-                message_queues[s].put(reply)
-                if s not in outputs:
-                    outputs.append(s)
-            else:
-                if s in outputs:
-                    outputs.remove(s)
-                inputs.remove(s)
-                s.close()
-                del message_queues[s]
-
-    for s in writable:
+                reply, complete = await self.transact(request)
+                if complete:
+                    self.cache.put(request, reply)
+                    if reply[3] == esmart.CMD_REPLY and reply[4] == esmart.BLOCK_STATUS:
+                        self.read_status(reply)
+                if not cacheable(request):
+                    # A write such as LOAD_ON changes the status, so status
+                    # requests after it must not be answered from the cache.
+                    self.cache.invalidate()
+                future.set_result(reply)
+            except Exception as exception:
+                future.set_exception(exception)
+            finally:
+                if self.inflight.get(request) is future:
+                    del self.inflight[request]
+
+    def read_status(self, reply):
         try:
-            next_msg = message_queues[s].get_nowait()
-        except queue.Empty:
-            outputs.remove(s)
-        else:
-            s.send(next_msg)
+            self.status = esmart.parse(reply)
+        except esmart.esmartError:
+            return
+        if self.on_status:
+            self.on_status()
+
+    # Send a request to the eSmart device and return its reply, which is the first
+    # complete frame, or whatever arrived if no complete frame arrives in time, and
+    # whether the reply is a complete frame.
+    async def transact(self, request):
+        if not self.ser:
+            await self.reopen()
+        for frame in self.decoder.frames():
+            pass
+        self.received = b''
+
+        try:
+            self.ser.write(request)
+        except (serial.serialutil.SerialException, OSError):
+            await self.reopen()
+            self.ser.write(request)
+
+        started = time.perf_counter()
+        deadline = time.time() + SERIAL_TIMEOUT
+        while True:
+            for frame in self.decoder.frames():
+                self.transact_seconds.observe(time.perf_counter() - started)
+                return frame, True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.timeouts.inc()
+                return self.received, False
+            self.readable.clear()
+            try:
+                await asyncio.wait_for(self.readable.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def subscribe(self, outgoing):
+        self.subscribers.add(outgoing)
+        self.subscribed.set()
+
+    def unsubscribe(self, outgoing):
+        self.subscribers.discard(outgoing)
+
+    # Subscribe a client to compact samples, first sending those in the ring
+    # taken after since, if given
+    def subscribe_compact(self, outgoing, since=None):
+        subscriber = compactsubscriber(self, outgoing)
+        self.compact.add(subscriber)
+        if since is not None:
+            subscriber.add([sample for sample in self.ring if sample[0] > since])
+        self.subscribed.set()
+        return subscriber
+
+    def unsubscribe_compact(self, subscriber):
+        self.compact.discard(subscriber)
+        self.retain_until = time.time() + RING_SAMPLES * SUBSCRIBE_SECS
+
+    # Keep a polled status in the ring and send it to compact subscribers. Times
+    # are rounded as they are sent, so that clients can ask for samples after the
+    # last one they have.
+    def record(self, reply):
+        try:
+            values = esmart.STATUS_LAYOUT.unpack_from(reply, esmart.STATUS_OFFSET)
+        except struct.error:
+            return
+        sample = (round(time.time(), 1), values)
+        self.ring.append(sample)
+        for subscriber in self.compact:
+            subscriber.add([sample])
+
+    # Poll the charger at a fixed rate, however many clients are subscribed
+    async def poller(self):
+        while True:
+            if not (self.subscribers or self.compact or time.time() < self.retain_until):
+                self.subscribed.clear()
+            await self.subscribed.wait()
+            started = time.time()
+            try:
+                # Each poll is a new sample, so it must come from the charger
+                reply = await self.request(esmart.REQUEST_MSG0, cached=False)
+            except Exception:
+                reply = None
+            if reply and reply[0] == 0xaa and not sum(reply) & 0xff:
+                reply = self.addressed(reply)
+                for outgoing in list(self.subscribers):
+                    if outgoing.full():
+                        # Slow subscriber, so drop its oldest sample. If that is
+                        # a compact subscriber's place in the queue, its samples
+                        # wait for the next add() to queue it again.
+                        dropped = outgoing.get_nowait()
+                        if isinstance(dropped, compactsubscriber):
+                            dropped.queued = False
+                    outgoing.put_nowait(reply)
+                self.record(reply)
+            await asyncio.sleep(max(SUBSCRIBE_SECS - (time.time() - started), 0))
+
+# Each client has a reader that forwards its requests and a writer that sends
+# the replies, so a client that stops reading only fills its own queue.
+async def send(writer, outgoing):
+    while True:
+        message = await outgoing.get()
+        if isinstance(message, compactsubscriber):
+            await message.wait(writer)
+            message = message.flush()
+        writer.write(message)
+        await writer.drain()
+
+# Request frames from a client, and command lines such as STATS, which come
+# between frames and end with a newline. Text before a start character without
+# a newline is kept as the start of a command, up to COMMAND_MAX bytes.
+class requestdecoder(esmart.decoder):
+    def frames(self):
+        buffer = self.buffer
+        while True:
+            start = buffer.find(0xaa)
+            end = buffer.find(b'\n', 0, len(buffer) if start == -1 else start)
+            if end != -1:
+                command = bytes(buffer[:end]).strip()
+                del buffer[:end + 1]
+                if command:
+                    yield command
+                continue
+            if start == -1:
+                if len(buffer) > COMMAND_MAX:
+                    del buffer[:]
+                return
+            frame = next(super().frames(), None)
+            if not frame:
+                return
+            yield frame
+
+# Requests for one charger are answered in order, but requests for different
+# chargers in the same read go to them all at once.
+async def forward(dev, requests, outgoing):
+    for request in requests:
+        reply = await dev.request(esmart.readdress(request, esmart.DEFAULT_ADDRESS))
+        if reply:
+            outgoing.put_nowait(dev.addressed(reply))
+
+async def handle_client(reader, writer, devices):
+    outgoing = asyncio.Queue(CLIENT_QUEUE)
+    sender = asyncio.ensure_future(send(writer, outgoing))
+    decoder = requestdecoder()
+    compact = []
+    CLIENTS.inc()
+    try:
+        while not sender.done():
+            data = await reader.read(1024)
+            if not data:
+                break
+
+            decoder.feed(data)
+            requests = {}
+            for request in decoder.frames():
+                if request[0] == 0xaa:
+                    if request[esmart.FRAME_ADDRESS] in devices:
+                        requests.setdefault(request[esmart.FRAME_ADDRESS], []).append(request)
+                    continue
+
+                fields = request.split()
+                if fields[0] == STATS_MSG:
+                    outgoing.put_nowait(b''.join(b"address=%d device=%s " % (dev.address, dev.serdevice.encode()) + dev.cache.stats() for dev in devices.values()))
+                elif fields[0] == esmart.SUBSCRIBE_MSG:
+                    # SUBSCRIBE [unit], or every charger without one
+                    try:
+                        addresses = [int(fields[1])] if len(fields) > 1 else list(devices)
+                    except ValueError:
+                        continue
+                    for address in addresses:
+                        if address in devices:
+                            devices[address].subscribe(outgoing)
+                elif fields[0] == esmart.SAMPLES_MSG:
+                    # SAMPLES unit [time of the newest sample the client has]
+                    try:
+                        address = int(fields[1])
+                        since = float(fields[2]) if len(fields) > 2 else None
+                    except (IndexError, ValueError):
+                        continue
+                    if address in devices:
+                        compact.append(devices[address].subscribe_compact(outgoing, since))
+            await asyncio.gather(*(forward(devices[address], requests[address], outgoing) for address in requests))
+    except (asyncio.QueueFull, ConnectionError):
+        pass
+    finally:
+        for dev in devices.values():
+            dev.unsubscribe(outgoing)
+        for subscriber in compact:
+            subscriber.dev.unsubscribe_compact(subscriber)
+        CLIENTS.dec()
+        sender.cancel()
+        writer.close()
+
+# Publish the combined status of the chargers that have been read
+def publish_status(publisher, devices):
+    statuses = [dev.status for dev in devices.values() if dev.status]
+    publisher.publish_status(esmart.aggregate(statuses), len(statuses))
+
+async def main():
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    publisher = snapshot.publisher(SNAPSHOT_PATH) if SNAPSHOT_PATH else None
+
+    devices = {}
+    for address, (serdevice, ser) in enumerate(open_serials(), esmart.DEFAULT_ADDRESS):
+        dev = devices[address] = device(serdevice, ser, replycache(CACHE_MAX_AGE), address)
+        if publisher:
+            dev.on_status = lambda: publish_status(publisher, devices)
+        asyncio.ensure_future(dev.worker())
+        asyncio.ensure_future(dev.poller())
 
-    for s in exceptional:
-        inputs.remove(s)
-        if s in outputs:
-            outputs.remove(s)
-        s.close()
-        del message_queues[s]
+    server = await asyncio.start_server(lambda reader, writer: handle_client(reader, writer, devices), HOST or None, PORT, reuse_address=True)
+    async with server:
+        await server.serve_forever()
 
-server.close()
\ No newline at end of file
+if __name__ == '__main__':
+    asyncio.run(main())
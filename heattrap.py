@@ -1,20 +1,36 @@
 # Library for communicating with Heat Trap hot water system
 # Copyright 2020 Jonathan Schultz
 
-import re, sys, time, select
+import sys, time, select
+import metrics
 try:
     import serial
 except ModuleNotFoundError:
     pass
 
 
-EOLCHARS = b'\r\n'
+TEMPPREFIX = b'THx,'
+TEMPFIELDS = [2, 3, 8, 1]
 
-tempregex = re.compile(r"THx,\s*(\S+),\s*(\S+),\s*(\S+),\s*(\S+),\s*(\S+),\s*(\S+),\s*(\S+),\s*(\S+)")
+LINES_PARSED = metrics.counter('heattrap_lines_total', 'Lines received from the Heat Trap controller', {'result': 'parsed'})
+LINES_REJECTED = metrics.counter('heattrap_lines_total', 'Lines received from the Heat Trap controller', {'result': 'rejected'})
 
 class heattrapError(Exception):
     pass
 
+# Parse a line such as "THx, 1, 2, 3, 4, 5, 6, 7, 8" into the temperature sensor
+# readings, or return None if it is not a valid temperature line.
+def parse(line):
+    if not line.startswith(TEMPPREFIX):
+        return None
+    fields = line.split(b',')
+    if len(fields) < 9:
+        return None
+    try:
+        return [int(fields[i]) for i in TEMPFIELDS]
+    except ValueError:
+        return None
+
 class heattrap:
     def __init__(self, port):
         self.serial = serial.Serial(port, baudrate=9600, timeout=0) if 'serial' in sys.modules else None
@@ -31,29 +47,32 @@ class heattrap:
         except AttributeError:
             pass
 
+    def fileno(self):
+        if not self.serial:
+            raise heattrapError("Heat Trap serial port is not open")
+        return self.serial.fileno()
+
+    # Return the temperature sensor readings from every complete line received,
+    # waiting up to timeout for data to arrive.
     def read(self, timeout=None):
-        tempsensors = None
+        readings = []
         if self.serial:
             readable, writable, exceptional = select.select([self.serial], [], [], timeout)
 
             if readable:
-                c = self.serial.read(1)
-                while c:
-                    if c in EOLCHARS:
-                        try:
-                            linematch = tempregex.match(self.line.decode('utf-8'))
-                        except UnicodeDecodeError:
-                            linematch = None
-                            pass
-                        if linematch:
-                            tempsensors = [int(linematch.group(i)) for i in [2,3,8,1]]
-
-                        self.line = bytearray()
-                    else:
-                        self.line += c
-
-                    c = self.serial.read(1)
+                self.line += self.serial.read(self.serial.in_waiting or 1)
+                end = max(self.line.rfind(b'\r'), self.line.rfind(b'\n'))
+                if end != -1:
+                    lines = self.line[:end].replace(b'\r', b'\n').split(b'\n')
+                    del self.line[:end + 1]
+                    for line in lines:
+                        tempsensors = parse(line)
+                        if tempsensors:
+                            LINES_PARSED.inc()
+                            readings.append(tempsensors)
+                        elif line:
+                            LINES_REJECTED.inc()
         else:
             time.sleep(timeout)
 
-        return tempsensors
+        return readings
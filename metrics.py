@@ -0,0 +1,116 @@
+# Counters, gauges and latency histograms, served in Prometheus text format
+# Copyright 2020 Jonathan Schultz
+#
+# Metrics are plain objects updated in place, so recording one costs an
+# attribute update, or a bisect for a histogram. They are only formatted when
+# the endpoint is scraped, from a thread started by serve().
+
+import bisect, threading, http.server
+
+METRICS_HOST = 'localhost'
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# Metrics by name and labels, so that creating a metric again, as when the
+# controller restarts, replaces it rather than adding a duplicate.
+registry = {}
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labelstring(labels, extra=None):
+    labels = list(labels) + ([extra] if extra else [])
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, escape(value)) for name, value in labels) + '}'
+
+# A counter or gauge given a function reads its value from it when scraped,
+# which suits values that are kept anyway, such as the server's cache counters.
+class metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=None, function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(sorted(labels.items())) if labels else ()
+        self.function = function
+        self.value = 0
+        registry[(name, self.labels)] = self
+
+    def samples(self):
+        return [('', (), self.function() if self.function else self.value)]
+
+class counter(metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class gauge(metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class histogram(metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        super().__init__(name, help, labels)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            samples.append(('_bucket', (('le', bound),), total))
+        samples.append(('_sum', (), self.sum))
+        samples.append(('_count', (), total))
+        return samples
+
+def render():
+    lines = []
+    described = set()
+    for (name, labels), metric in sorted(list(registry.items()), key=lambda item: item[0][0]):
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+        for suffix, extra, value in metric.samples():
+            lines.append('%s%s%s %s' % (name, suffix, labelstring(labels, extra[0] if extra else None), value))
+    return '\n'.join(lines) + '\n'
+
+class handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve the metrics at http://host:port/metrics from a daemon thread
+def serve(port, host=METRICS_HOST):
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
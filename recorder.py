@@ -0,0 +1,183 @@
+# Append-only time-series store for charger and tank samples
+# Copyright 2020 Jonathan Schultz
+#
+# Samples are fixed-width binary records appended to segment files, which are
+# named after the time of their first record. Segments are read back through
+# mmap and searched by time with a binary search, so long ranges can be scanned
+# without parsing text or loading everything into memory.
+
+import os, sys, mmap, struct, time, collections
+import esmart
+
+SEGMENT_SUFFIX = '.seg'
+SEGMENT_RECORDS = 120960    # One week of samples every 5 seconds
+
+TEMPSENSORS = 4
+NO_READING = -32768
+
+# Timestamp, the status fields in their raw units (tenths of volts and amps) and
+# the tank temperature sensors.
+SAMPLE_LAYOUT = struct.Struct('<dHHHHHHHHBBBH%dh' % TEMPSENSORS)
+SAMPLE_FIELDS = ['time'] + esmart.STATUS_FIELDS + ['temp%d' % sensor for sensor in range(TEMPSENSORS)]
+SAMPLE_SCALE = [1] + esmart.STATUS_SCALE + [1] * TEMPSENSORS
+
+# The most each status field holds. Fields summed over several chargers, such
+# as co2_gram, can go past it, and are recorded as this.
+STATUS_MAX = [(1 << 8 * struct.calcsize(code)) - 1 for code in SAMPLE_LAYOUT.format[2:2 + len(esmart.STATUS_FIELDS)]]
+
+TIME_LAYOUT = struct.Struct('<d')
+
+sample = collections.namedtuple('sample', SAMPLE_FIELDS)
+
+class recorderError(Exception):
+    pass
+
+# A directory of segment files holding records of one layout, the first field
+# of which is the timestamp.
+class segmentstore:
+    def __init__(self, path, layout, segment_records=SEGMENT_RECORDS):
+        self.path = path
+        self.layout = layout
+        self.segment_records = segment_records
+        self.file = None
+        self.count = 0
+        os.makedirs(path, exist_ok=True)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def segments(self):
+        segments = []
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.path, name)))
+                except ValueError:
+                    pass
+        segments.sort()
+        return segments
+
+    # Continue the newest segment if it has room, dropping any partial record
+    # left by a crash, otherwise start a new one.
+    def open(self, timestamp):
+        segments = self.segments()
+        if segments:
+            filename = segments[-1][1]
+            count = os.path.getsize(filename) // self.layout.size
+            if count < self.segment_records:
+                self.file = open(filename, 'r+b')
+                self.file.truncate(count * self.layout.size)
+                self.file.seek(0, os.SEEK_END)
+                self.count = count
+                return
+        self.rotate(timestamp)
+
+    def rotate(self, timestamp):
+        self.close()
+        filename = os.path.join(self.path, '%010d%s' % (int(timestamp), SEGMENT_SUFFIX))
+        self.file = open(filename, 'ab')
+        self.count = 0
+
+    def append(self, values):
+        if not self.file:
+            self.open(values[0])
+        elif self.count >= self.segment_records:
+            self.rotate(values[0])
+        self.file.write(self.layout.pack(*values))
+        self.file.flush()
+        self.count += 1
+
+    # Yield the records with timestamps from start up to but not including end.
+    def query(self, start=None, end=None):
+        segments = self.segments()
+        for index, (first, filename) in enumerate(segments):
+            if end is not None and first >= end:
+                break
+            if start is not None and index + 1 < len(segments) and segments[index + 1][0] <= start:
+                continue
+
+            with open(filename, 'rb') as file:
+                count = os.path.getsize(filename) // self.layout.size
+                if not count:
+                    continue
+                with mmap.mmap(file.fileno(), count * self.layout.size, access=mmap.ACCESS_READ) as records:
+                    position = self.search(records, count, start) if start is not None else 0
+                    while position < count:
+                        values = self.layout.unpack_from(records, position * self.layout.size)
+                        if end is not None and values[0] >= end:
+                            return
+                        yield values
+                        position += 1
+
+    # The newest record, or None if there are none
+    def last(self):
+        for first, filename in reversed(self.segments()):
+            count = os.path.getsize(filename) // self.layout.size
+            if count:
+                with open(filename, 'rb') as file:
+                    file.seek((count - 1) * self.layout.size)
+                    return self.layout.unpack(file.read(self.layout.size))
+        return None
+
+    # Index of the first record with a timestamp not less than timestamp
+    def search(self, records, count, timestamp):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if TIME_LAYOUT.unpack_from(records, middle * self.layout.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+class recorder:
+    def __init__(self, path, segment_records=SEGMENT_RECORDS):
+        self.store = segmentstore(path, SAMPLE_LAYOUT, segment_records)
+        self.tempsensors = None
+
+    def close(self):
+        self.store.close()
+
+    # Tank temperatures arrive separately from charger status, so keep the
+    # latest readings to store with the next status sample, or None to store
+    # NO_READING while there are none.
+    def record_temps(self, tempsensors):
+        self.tempsensors = tempsensors
+
+    # A group status from several chargers is recorded as its status fields
+    # alone, without the number of units and the voltage range.
+    def record(self, status, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        status = status[:len(esmart.STATUS_FIELDS)]
+        tempsensors = self.tempsensors or [NO_READING] * TEMPSENSORS
+        values = [timestamp]
+        for value, scale, maximum in zip(status, esmart.STATUS_SCALE, STATUS_MAX):
+            values.append(min(int(round(value * scale)), maximum))
+        values.extend(tempsensors)
+        try:
+            self.store.append(values)
+        except struct.error as exception:
+            raise recorderError("Sample out of range: %s" % exception)
+        return sample(timestamp, *status, *tempsensors)
+
+    def query(self, start=None, end=None):
+        for values in self.store.query(start, end):
+            yield sample._make(value / scale if scale != 1 else value for value, scale in zip(values, SAMPLE_SCALE))
+
+if __name__ == '__main__':
+    # Dump recorded samples as CSV: recorder.py PATH [START [END]]
+    if len(sys.argv) < 2:
+        print('Usage: recorder.py PATH [START [END]]')
+        sys.exit(1)
+    start = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    end = float(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    print(','.join(SAMPLE_FIELDS))
+    for record in recorder(sys.argv[1]).query(start, end):
+        print(','.join(str(value) for value in record))
@@ -0,0 +1,383 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Accelerated replay and simulation of the esmart_fsm controller
+#
+# Copyright (2020) Jonathan Schultz
+#
+# Recorded or simulated charger and tank data is fed to esmartfsm through
+# stand-ins for the eSmart charger, the Heat Trap controller and the PiFace
+# relays. Everything runs on a virtual clock, so that timers and ticks take no
+# real time and a year of data can be evaluated in seconds. Parameters such as
+# FULL_VOLT or HOT_DEGREES can be swept, with each combination run in its own
+# process.
+#
+# Examples:
+#   replay.py --days 365
+#   replay.py --record /var/lib/esmart --sweep FULL_VOLT=14.0,14.2,14.4 --sweep HOT_DEGREES=57,59
+#   replay.py --record /var/lib/esmart --start 1577836800 --end 1580515200
+#
+# Recordings have gaps wherever the daemon was down; the charger stand-in is
+# reconnected across them as the real one would be.
+
+import time, math, random, logging, argparse, itertools, selectors, multiprocessing
+import esmart
+import recorder
+import esmart_fsm
+
+TRIGGERS = ['full', 'low', 'critical', 'tick', 'hot', 'cold', 'timeout']
+
+class virtualclock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, secs):
+        self.now += secs
+
+# Stand-in for a PiFace relay that counts switches and time switched on
+class fakerelay:
+    def __init__(self, clock):
+        self.clock = clock
+        self.state = 0
+        self.switches = 0
+        self.on_secs = 0.0
+        self.since = None
+
+    @property
+    def value(self):
+        return self.state
+
+    @value.setter
+    def value(self, value):
+        if value == self.state:
+            return
+        if value:
+            self.since = self.clock()
+        else:
+            self.on_secs += self.clock() - self.since
+        self.state = value
+        self.switches += 1
+
+    def on_time(self):
+        return self.on_secs + (self.clock() - self.since if self.state else 0.0)
+
+class fakepiface:
+    def __init__(self, clock):
+        self.relays = [fakerelay(clock) for relay in range(8)]
+
+    def deinit_board(self):
+        pass
+
+# Stand-in for the selector, which advances the virtual clock to the next time
+# a stand-in device has data or the timeout expires, whichever comes first.
+class virtualselector:
+    def __init__(self, clock):
+        self.clock = clock
+        self.keys = []
+
+    def register(self, fileobj, events, data=None):
+        key = selectors.SelectorKey(fileobj, len(self.keys), events, data)
+        self.keys.append(key)
+        return key
+
+    def unregister(self, fileobj):
+        for key in self.keys:
+            if key.fileobj is fileobj:
+                self.keys.remove(key)
+                return key
+        raise KeyError(fileobj)
+
+    def select(self, timeout=None):
+        due = [(key, key.fileobj.next_time()) for key in self.keys]
+        due = [(key, when) for key, when in due if when is not None]
+        first = min((when for key, when in due), default=None)
+        limit = self.clock() + timeout if timeout is not None else None
+        if first is None or (limit is not None and first > limit):
+            if limit is None:
+                raise RuntimeError('Nothing left to replay')
+            self.clock.now = limit
+            return []
+        self.clock.now = max(self.clock(), first)
+        return [(key, selectors.EVENT_READ) for key, when in due if when <= self.clock()]
+
+# Stand-in for esmart.esmart. A status request is answered at once with the
+# latest sample; when subscribed, each sample is delivered at its time.
+class fakecharger:
+    def __init__(self, clock, samples):
+        self.unit = esmart.DEFAULT_ADDRESS
+        self.clock = clock
+        self.samples = samples
+        self.current = None
+        self.fresh = False
+        self.upcoming = next(self.samples, None)
+        self.subscribed = False
+        self.requested = False
+
+    def subscribe(self, compact=False):
+        self.subscribed = True
+
+    def set_load(self, on):
+        self.load = on
+
+    def request(self):
+        self.requested = True
+
+    def connected(self):
+        return True
+
+    def healthy(self):
+        return True
+
+    def reconnect(self, wait=True):
+        return 'replay'
+
+    def retry_delay(self):
+        return 0
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+    def next_time(self):
+        if not self.upcoming:
+            return self.clock() if self.requested and self.current else None
+        if self.subscribed:
+            return self.upcoming[0]
+        if self.requested:
+            return self.clock() if self.current else self.upcoming[0]
+        return None
+
+    def poll(self):
+        while self.upcoming and self.upcoming[0] <= self.clock():
+            self.current = self.upcoming[1]
+            self.fresh = True
+            self.upcoming = next(self.samples, None)
+        if self.subscribed:
+            if not self.fresh:
+                return None
+        elif not self.requested:
+            return None
+        self.fresh = False
+        self.requested = False
+        return self.current
+
+# Stand-in for heattrap.heattrap
+class faketank:
+    def __init__(self, clock, readings):
+        self.clock = clock
+        self.readings = readings
+        self.upcoming = next(self.readings, None)
+
+    def close(self):
+        pass
+
+    def next_time(self):
+        return self.upcoming[0] if self.upcoming else None
+
+    def read(self, timeout=None):
+        readings = []
+        while self.upcoming and self.upcoming[0] <= self.clock():
+            readings.append(self.upcoming[1])
+            self.upcoming = next(self.readings, None)
+        return readings
+
+# Samples recorded by esmart_fsm
+class recordedsource:
+    def __init__(self, path, start=None, end=None):
+        self.path = path
+        self.start = start
+        self.end = end
+
+    def span(self):
+        samples = recorder.recorder(self.path)
+        first = next(samples.query(self.start, self.end), None)
+        last = samples.store.last()
+        if not first or not last:
+            raise RuntimeError('No samples recorded in %s' % self.path)
+        return first.time, min(last[0], self.end) if self.end else last[0]
+
+    def devices(self, clock, piface):
+        def statuses():
+            for sample in recorder.recorder(self.path).query(self.start, self.end):
+                yield sample.time, esmart.status(*sample[1:1 + len(esmart.STATUS_FIELDS)])
+
+        def readings():
+            for sample in recorder.recorder(self.path).query(self.start, self.end):
+                tempsensors = list(sample[1 + len(esmart.STATUS_FIELDS):])
+                if recorder.NO_READING not in tempsensors:
+                    yield sample.time, tempsensors
+
+        return fakecharger(clock, statuses()), faketank(clock, readings())
+
+# A simple model of the battery, panels and tank, which responds to the relays
+# so that the effect of the controller on the system shows up.
+class simulatedsource:
+    SAMPLE_SECS = 5
+    CAPACITY_AH = 400.0
+    PEAK_CUR = 60.0
+    BASE_CUR = 2.0
+    HEAT_PUMP_CUR = 20.0
+    HEAT_DEGREES_PER_HOUR = 6.0
+    LOSS_DEGREES_PER_HOUR = 0.7
+
+    def __init__(self, days, seed=0, start=1577836800.0):
+        self.days = days
+        self.seed = seed
+        self.start = start
+
+    def span(self):
+        return self.start, self.start + self.days * 86400
+
+    def devices(self, clock, piface):
+        random.seed(self.seed)
+        state = {'soc': 0.6, 'temp': 50.0}
+        volts = esmart_fsm.CELLS / 6.0
+        cloud = [random.uniform(0.3, 1.0) for day in range(self.days + 1)]
+        heat_pump = piface.relays[esmart_fsm.HEAT_PUMP_RELAY]
+
+        def statuses():
+            now = self.start
+            end = self.start + self.days * 86400
+            while now < end:
+                hour = (now - self.start) % 86400 / 3600.0
+                sun = max(0.0, math.sin(math.pi * (hour - 6) / 12)) * cloud[int((now - self.start) // 86400)]
+                load = self.BASE_CUR + (self.HEAT_PUMP_CUR if heat_pump.value else 0.0)
+                chg_cur = sun * self.PEAK_CUR if state['soc'] < 1.0 else min(sun * self.PEAK_CUR, load)
+                state['soc'] = min(1.0, max(0.0, state['soc'] + (chg_cur - load) * self.SAMPLE_SECS / 3600.0 / self.CAPACITY_AH))
+
+                bat_volt = (12.0 + 1.2 * state['soc'] + 0.01 * (chg_cur - load)) * volts
+                if state['soc'] >= 1.0:
+                    chg_mode = 3
+                    bat_volt = 13.6 * volts
+                elif bat_volt >= 14.4 * volts:
+                    chg_mode = 2
+                    bat_volt = 14.4 * volts
+                else:
+                    chg_mode = 1 if chg_cur else 0
+
+                yield now, esmart.status(chg_mode, round(sun * 100, 1), round(bat_volt, 1), round(chg_cur, 1), round(bat_volt, 1), round(load, 1),
+                                         int(chg_cur * bat_volt), int(load * bat_volt), 25, 30, int(state['soc'] * 100), 0)
+                now += self.SAMPLE_SECS
+
+        def readings():
+            now = self.start
+            while True:
+                state['temp'] += ((self.HEAT_DEGREES_PER_HOUR if heat_pump.value else 0.0) - self.LOSS_DEGREES_PER_HOUR) * self.SAMPLE_SECS / 3600.0
+                temp = int(round(state['temp']))
+                yield now, [temp - 5, temp, temp - 2, temp - 10]
+                now += self.SAMPLE_SECS
+
+        return fakecharger(clock, statuses()), faketank(clock, readings())
+
+def replay(source, params={}):
+    for name, value in params.items():
+        setattr(esmart_fsm, name, value)
+    esmart_fsm.RECORD_PATH = None
+    esmart_fsm.SNAPSHOT_PATH = None
+    esmart_fsm.CHECKPOINT_PATH = None
+    esmart_fsm.API_PORT = None
+
+    start, end = source.span()
+    clock = virtualclock(start)
+    piface = fakepiface(clock)
+    charger, tank = source.devices(clock, piface)
+
+    counts = {trigger: 0 for trigger in TRIGGERS}
+    restarts = 0
+
+    def create():
+        fsm = esmart_fsm.esmartfsm(chargers=[charger], tank=tank, piface=piface, clock=clock, selector=virtualselector(clock))
+        for trigger in TRIGGERS:
+            def counted(*args, trigger=trigger, method=getattr(fsm, trigger)):
+                counts[trigger] += 1
+                return method(*args)
+            setattr(fsm, trigger, counted)
+        return fsm
+
+    wallstart = time.time()
+    fsm = create()
+    while clock() < end:
+        try:
+            fsm.step()
+        except Exception:
+            # There is no checkpoint to restart from, so do as the daemon does
+            # once its warm restarts run out: pumps off, wait and start again
+            logging.exception('Controller failed at %s' % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(clock())))
+            fsm.turn_heat_pump_off()
+            fsm.turn_circulation_pump_off()
+            restarts += 1
+            clock.advance(esmart_fsm.RETRY_SLEEP_SECS)
+            fsm = create()
+    wallsecs = time.time() - wallstart
+
+    decisions = sum(counts.values())
+    heat_pump = piface.relays[esmart_fsm.HEAT_PUMP_RELAY]
+    circulation_pump = piface.relays[esmart_fsm.CIRCULATION_PUMP_RELAY]
+    return {
+        'params': params,
+        'days': (end - start) / 86400,
+        'heat_pump_switches': heat_pump.switches,
+        'circulation_pump_switches': circulation_pump.switches,
+        'heat_pump_hours': heat_pump.on_time() / 3600,
+        'circulation_pump_hours': circulation_pump.on_time() / 3600,
+        'triggers': counts,
+        'restarts': restarts,
+        'decisions': decisions,
+        'decisions_per_sec': decisions / wallsecs if wallsecs else 0.0,
+        'wall_secs': wallsecs,
+        'final_state': fsm.state,
+    }
+
+def run(job):
+    source, params = job
+    return replay(source, params)
+
+def parse_sweep(sweeps):
+    names = []
+    choices = []
+    for sweep in sweeps:
+        name, values = sweep.split('=', 1)
+        if not hasattr(esmart_fsm, name):
+            raise SystemExit('Unknown parameter: %s' % name)
+        names.append(name)
+        kind = type(getattr(esmart_fsm, name))
+        if kind is type(None):
+            kind = float
+        if kind is bool:
+            choices.append([value.lower() in ('1', 'true', 'yes') for value in values.split(',')])
+        else:
+            choices.append([kind(value) for value in values.split(',')])
+    return [dict(zip(names, combination)) for combination in itertools.product(*choices)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded or simulated data through the eSmart/heattrap controller.')
+    parser.add_argument('--record', help='directory of samples recorded by esmart_fsm.py')
+    parser.add_argument('--start', type=float, help='start time of recorded samples to replay')
+    parser.add_argument('--end', type=float, help='end time of recorded samples to replay')
+    parser.add_argument('--days', type=int, default=365, help='days to simulate when no recording is given')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the simulation')
+    parser.add_argument('--sweep', action='append', default=[], help='NAME=VALUE,VALUE,... parameter values to try')
+    parser.add_argument('--processes', type=int, help='number of processes for a sweep')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    source = recordedsource(args.record, args.start, args.end) if args.record else simulatedsource(args.days, args.seed)
+    jobs = [(source, params) for params in parse_sweep(args.sweep)]
+    if len(jobs) > 1:
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.map(run, jobs)
+    else:
+        results = [run(job) for job in jobs]
+
+    for result in results:
+        print('%s: %.0f days, heat pump %d switches %.1f hours, circulation pump %d switches %.1f hours, %d restarts, %d decisions at %.0f/s, final state %s' % (
+            ' '.join('%s=%s' % item for item in result['params'].items()) or 'defaults',
+            result['days'], result['heat_pump_switches'], result['heat_pump_hours'],
+            result['circulation_pump_switches'], result['circulation_pump_hours'],
+            result['restarts'], result['decisions'], result['decisions_per_sec'], result['final_state']))
@@ -0,0 +1,158 @@
+# Multi-resolution rollups of recorded charger and tank samples
+# Copyright 2020 Jonathan Schultz
+#
+# For each resolution the minimum, maximum and mean of each metric over every
+# bucket is kept in a segment store like the one used for raw samples. Buckets
+# are accumulated as samples are recorded and written when they are complete.
+
+import os, sys, struct
+import recorder
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+RESOLUTIONS = [MINUTE, HOUR, DAY]
+
+# chg_power is the charger's output power, which is what it draws from the panels
+# less conversion losses. temp1 is the tank sensor that the FSM acts on.
+METRICS = ['bat_volt', 'chg_cur', 'chg_power', 'temp1']
+
+# Bucket start time, then sample count, minimum, maximum and mean of each metric
+ROLLUP_LAYOUT = struct.Struct('<d' + 'Iddd' * len(METRICS))
+
+class rollupError(Exception):
+    pass
+
+class bucket:
+    def __init__(self, start):
+        self.start = start
+        self.count = [0] * len(METRICS)
+        self.minimum = [0.0] * len(METRICS)
+        self.maximum = [0.0] * len(METRICS)
+        self.total = [0.0] * len(METRICS)
+
+    def add(self, sample):
+        for index, metric in enumerate(METRICS):
+            value = getattr(sample, metric)
+            if value == recorder.NO_READING:
+                continue
+            if self.count[index]:
+                if value < self.minimum[index]:
+                    self.minimum[index] = value
+                elif value > self.maximum[index]:
+                    self.maximum[index] = value
+            else:
+                self.minimum[index] = self.maximum[index] = value
+            self.count[index] += 1
+            self.total[index] += value
+
+    def values(self):
+        values = [self.start]
+        for index in range(len(METRICS)):
+            count = self.count[index]
+            values += [count, self.minimum[index], self.maximum[index], self.total[index] / count if count else 0.0]
+        return values
+
+    def summary(self, index):
+        count = self.count[index]
+        return (self.start, self.minimum[index], self.maximum[index], self.total[index] / count) if count else None
+
+class rollup:
+    def __init__(self, path, samples=None):
+        self.samples = samples
+        self.stores = {}
+        self.buckets = {}
+        self.flushed = {}
+        for resolution in RESOLUTIONS:
+            store = recorder.segmentstore(os.path.join(path, str(resolution)), ROLLUP_LAYOUT)
+            self.stores[resolution] = store
+            self.buckets[resolution] = None
+            last = store.last()
+            self.flushed[resolution] = last[0] if last else None
+
+        if samples:
+            self.catch_up()
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+    # Rebuild the buckets since the last one written, from the raw samples, so
+    # that a restart or a gap in rollups loses nothing.
+    def catch_up(self):
+        starts = [flushed + resolution if flushed is not None else None for resolution, flushed in self.flushed.items()]
+        start = None if None in starts else min(starts)
+        for sample in self.samples.query(start):
+            self.update(sample)
+
+    def update(self, sample):
+        for resolution in RESOLUTIONS:
+            start = sample.time - sample.time % resolution
+            flushed = self.flushed[resolution]
+            if flushed is not None and start <= flushed:
+                continue
+
+            current = self.buckets[resolution]
+            if current and current.start != start:
+                self.stores[resolution].append(current.values())
+                self.flushed[resolution] = current.start
+                current = None
+            if not current:
+                current = self.buckets[resolution] = bucket(start)
+            current.add(sample)
+
+    # The coarsest resolution that still gives at least the requested number of
+    # points, or None if no rollup is fine enough.
+    def resolution(self, start, end, points):
+        resolution = None
+        for candidate in RESOLUTIONS:
+            if (end - start) / candidate >= points:
+                resolution = candidate
+        return resolution
+
+    # Return (time, minimum, maximum, mean) tuples for a metric, at the coarsest
+    # resolution that still gives at least the requested number of points. If no
+    # rollup is fine enough, raw samples are returned as they are.
+    def query(self, metric, start, end, points):
+        return self.rows(metric, start, end, self.resolution(start, end, points))
+
+    # The same at a given resolution, or raw samples for None
+    def rows(self, metric, start, end, resolution):
+        if metric not in METRICS:
+            raise rollupError("Unknown metric: %s" % metric)
+        index = METRICS.index(metric)
+
+        if resolution is None and self.samples:
+            result = []
+            for sample in self.samples.query(start, end):
+                value = getattr(sample, metric)
+                if value != recorder.NO_READING:
+                    result.append((sample.time, value, value, value))
+            return result
+
+        resolution = resolution or RESOLUTIONS[0]
+        result = []
+        offset = 1 + 4 * index
+        start -= start % resolution
+        for values in self.stores[resolution].query(start, end):
+            count, minimum, maximum, mean = values[offset:offset + 4]
+            if count:
+                result.append((values[0], minimum, maximum, mean))
+
+        current = self.buckets[resolution]
+        if current and start <= current.start < end and current.summary(index):
+            result.append(current.summary(index))
+        return result
+
+if __name__ == '__main__':
+    # Print rollups as CSV: rollup.py PATH METRIC START END POINTS
+    if len(sys.argv) < 6:
+        print('Usage: rollup.py PATH METRIC START END POINTS')
+        sys.exit(1)
+    path = sys.argv[1]
+    samples = recorder.recorder(path)
+    rollups = rollup(os.path.join(path, 'rollup'), samples)
+
+    print('time,min,max,mean')
+    for row in rollups.query(sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), int(sys.argv[5])):
+        print(','.join(str(value) for value in row))
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# Latest charger status, tank temperatures and controller state in shared memory
+# Copyright 2020 Jonathan Schultz
+#
+# esmart_server and esmart_fsm each publish to a small file, normally on the
+# /dev/shm tmpfs, which readers map and copy, so that any number of local tools
+# can see the current state in microseconds without touching the charger.
+#
+# The file is a header holding a sequence number, then the snapshot. A writer
+# makes the sequence odd, writes the snapshot and makes it even again. A reader
+# copies the snapshot between two reads of the sequence and tries again unless
+# both are the same even number, so it never sees half an update.
+
+import os, sys, mmap, json, time, struct, collections
+import esmart
+import recorder
+
+MAGIC = b'ESNP'
+VERSION = 1
+
+HEADER_LAYOUT = struct.Struct('<4sHxxQ')
+SEQUENCE_LAYOUT = struct.Struct('<Q')
+SEQUENCE_OFFSET = 8
+
+STATE_LEN = 32
+
+# Time of the status, the charge mode and the other status fields scaled to
+# volts and amps, and the number of chargers it covers; time of the temperatures
+# and the temperatures; time the controller entered its state and the state.
+SNAPSHOT_LAYOUT = struct.Struct('<dB%ddH d%dh d%ds' % (len(esmart.STATUS_FIELDS) - 1, recorder.TEMPSENSORS, STATE_LEN))
+SNAPSHOT_FIELDS = (['status_time'] + esmart.STATUS_FIELDS + ['units'] +
+                   ['temps_time'] + ['temp%d' % sensor for sensor in range(recorder.TEMPSENSORS)] +
+                   ['state_time', 'state'])
+SNAPSHOT_SIZE = HEADER_LAYOUT.size + SNAPSHOT_LAYOUT.size
+
+# A reader gives up if every copy in this many seconds overlaps a write
+READ_TIMEOUT = 1.0
+
+snapshot = collections.namedtuple('snapshot', ['sequence'] + SNAPSHOT_FIELDS)
+
+class snapshotError(Exception):
+    pass
+
+class publisher:
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != SNAPSHOT_SIZE:
+                os.ftruncate(fd, SNAPSHOT_SIZE)
+            self.map = mmap.mmap(fd, SNAPSHOT_SIZE)
+        finally:
+            os.close(fd)
+
+        # Carry on from the sequence already there, so that readers polling
+        # across a restart still see it change.
+        magic, version, sequence = HEADER_LAYOUT.unpack_from(self.map)
+        self.sequence = sequence + (sequence & 1) if magic == MAGIC and version == VERSION else 0
+        HEADER_LAYOUT.pack_into(self.map, 0, MAGIC, VERSION, self.sequence)
+
+        self.status = [0] + [0.0] * (len(esmart.STATUS_FIELDS) - 1) + [0]
+        self.status_time = 0.0
+        self.temps = [recorder.NO_READING] * recorder.TEMPSENSORS
+        self.temps_time = 0.0
+        self.state = b''
+        self.state_time = 0.0
+        self.buffer = bytearray(SNAPSHOT_LAYOUT.size)
+
+    def close(self):
+        self.map.close()
+
+    def publish_status(self, status, units=1, timestamp=None):
+        self.status = list(status[:len(esmart.STATUS_FIELDS)]) + [units]
+        self.status_time = timestamp or time.time()
+        self.write()
+
+    def publish_temps(self, tempsensors, timestamp=None):
+        self.temps = list(tempsensors)
+        self.temps_time = timestamp or time.time()
+        self.write()
+
+    def publish_state(self, state, timestamp=None):
+        self.state = state.encode()[:STATE_LEN]
+        self.state_time = timestamp or time.time()
+        self.write()
+
+    # The snapshot is packed first, so that a value that won't pack can't leave
+    # the sequence odd, and the odd window is a single copy.
+    def write(self):
+        SNAPSHOT_LAYOUT.pack_into(self.buffer, 0, self.status_time, *self.status,
+                                  self.temps_time, *self.temps, self.state_time, self.state)
+        self.sequence += 1
+        SEQUENCE_LAYOUT.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+        self.map[HEADER_LAYOUT.size:] = self.buffer
+        self.sequence += 1
+        SEQUENCE_LAYOUT.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+
+class reader:
+    def __init__(self, path):
+        try:
+            with open(path, 'rb') as file:
+                self.map = mmap.mmap(file.fileno(), SNAPSHOT_SIZE, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as exception:
+            raise snapshotError("Can't map %s: %s" % (path, exception))
+        magic, version, sequence = HEADER_LAYOUT.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise snapshotError("%s is not a version %d snapshot" % (path, VERSION))
+
+    def close(self):
+        self.map.close()
+
+    def read(self):
+        deadline = None
+        while True:
+            before = SEQUENCE_LAYOUT.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+            if not before & 1:
+                values = SNAPSHOT_LAYOUT.unpack_from(self.map, HEADER_LAYOUT.size)
+                if SEQUENCE_LAYOUT.unpack_from(self.map, SEQUENCE_OFFSET)[0] == before:
+                    return snapshot(before, *values[:-1], values[-1].rstrip(b'\0').decode())
+            # Let the writer finish before trying again
+            if deadline is None:
+                deadline = time.monotonic() + READ_TIMEOUT
+            elif time.monotonic() > deadline:
+                raise snapshotError("Snapshot kept changing while being read")
+            time.sleep(0)
+
+if __name__ == '__main__':
+    # Print snapshots as JSON: snapshot.py PATH...
+    if len(sys.argv) < 2:
+        print('Usage: snapshot.py PATH...')
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        print(json.dumps(dict(path=path, **reader(path).read()._asdict())))
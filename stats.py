@@ -0,0 +1,135 @@
+# Incremental statistics of charger samples
+# Copyright 2020 Jonathan Schultz
+#
+# Each update takes constant time. Means and slopes are exponentially weighted
+# by the time between samples, so they mean the same whatever the sampling rate
+# and need no history. Windowed minimum and maximum keep a monotonic deque, so
+# each sample is added and removed once.
+
+import math, collections
+
+# Exponentially weighted mean with time constant secs. Samples usually come at
+# a steady rate, so the weight for the last interval is kept for the next.
+class ewma:
+    def __init__(self, secs):
+        self.secs = secs
+        self.value = None
+        self.time = None
+        self.interval = None
+        self.weight = 0.0
+
+    def update(self, time, value):
+        if self.value is None:
+            self.value = value
+        else:
+            interval = time - self.time
+            if interval != self.interval:
+                self.interval = interval
+                self.weight = 1 - math.exp(-max(interval, 0) / self.secs)
+            self.value += self.weight * (value - self.value)
+        self.time = time
+        return self.value
+
+# Minimum over the last secs seconds. The deque holds the samples that could
+# still become the minimum, in time order.
+class windowmin:
+    def __init__(self, secs):
+        self.secs = secs
+        self.samples = collections.deque()
+
+    def update(self, time, value):
+        samples = self.samples
+        while samples and value <= samples[-1][1]:
+            samples.pop()
+        samples.append((time, value))
+        while samples[0][0] <= time - self.secs:
+            samples.popleft()
+        return samples[0][1]
+
+    @property
+    def value(self):
+        return self.samples[0][1] if self.samples else None
+
+class windowmax(windowmin):
+    def update(self, time, value):
+        samples = self.samples
+        while samples and value >= samples[-1][1]:
+            samples.pop()
+        samples.append((time, value))
+        while samples[0][0] <= time - self.secs:
+            samples.popleft()
+        return samples[0][1]
+
+# Exponentially weighted least squares slope, in units per second, with time
+# constant secs. The sums are kept about the latest sample time so that they
+# stay small.
+class slope:
+    def __init__(self, secs):
+        self.secs = secs
+        self.time = None
+        self.weight = self.t = self.v = self.tt = self.tv = 0.0
+
+    def update(self, time, value):
+        if self.time is not None:
+            shift = time - self.time
+            decay = math.exp(-max(shift, 0) / self.secs)
+            # Move the origin to the new time, then decay the old samples
+            self.tt = decay * (self.tt - 2 * shift * self.t + shift * shift * self.weight)
+            self.tv = decay * (self.tv - shift * self.v)
+            self.t = decay * (self.t - shift * self.weight)
+            self.v = decay * self.v
+            self.weight = decay * self.weight
+        # The new sample is at the origin, so it adds nothing to t, tt or tv
+        self.time = time
+        self.weight += 1
+        self.v += value
+        return self.value
+
+    @property
+    def value(self):
+        spread = self.weight * self.tt - self.t * self.t
+        if spread <= 1e-9 * max(self.weight * self.tt, 1):
+            return 0.0
+        return (self.weight * self.tv - self.t * self.v) / spread
+
+STATISTICS = ['value', 'mean', 'min', 'max', 'slope']
+
+# The statistics of one quantity, such as battery voltage. Only those named in
+# statistics are kept; the others are None.
+class signal:
+    def __init__(self, mean_secs, window_secs, slope_secs, statistics=STATISTICS):
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown:
+            raise ValueError("Unknown statistic: %s" % ', '.join(sorted(unknown)))
+        self.value = None
+        self.average = ewma(mean_secs) if 'mean' in statistics else None
+        self.lowest = windowmin(window_secs) if 'min' in statistics else None
+        self.highest = windowmax(window_secs) if 'max' in statistics else None
+        self.trend = slope(slope_secs) if 'slope' in statistics else None
+        self.trackers = [tracker for tracker in (self.average, self.lowest, self.highest, self.trend) if tracker]
+
+    def update(self, time, value):
+        self.value = value
+        for tracker in self.trackers:
+            tracker.update(time, value)
+
+    @property
+    def mean(self):
+        return self.average.value if self.average else None
+
+    @property
+    def min(self):
+        return self.lowest.value if self.lowest else None
+
+    @property
+    def max(self):
+        return self.highest.value if self.highest else None
+
+    # Units per hour, which suits battery voltage
+    @property
+    def slope(self):
+        return self.trend.value * 3600 if self.trend else None
+
+    # Look a statistic up by name: value, mean, min, max or slope
+    def get(self, name):
+        return getattr(self, name)